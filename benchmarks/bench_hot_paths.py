@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for combined_server.py hot paths (offline)
+
+使い方:
+    python benchmarks/bench_hot_paths.py                  # ベースラインと比較
+    python benchmarks/bench_hot_paths.py --save-baseline  # ベースラインを更新
+    python benchmarks/bench_hot_paths.py --pages DIR      # 別のHTMLディレクトリでパーサー差分検証
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# ベンチマーク中はディスクへの永続化を行わない
+os.environ.setdefault('CHIP_STORE_PATH', '')
+
+import logging
+logging.disable(logging.WARNING)
+
+import combined_server as server
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+PAGES_DIR = os.path.join(ROOT_DIR, 'tests', 'fixtures', 'chip_history_pages')
+
+STORES = ['京都河原町店', '神戸三宮店', '滋賀南草津店']
+
+# 📄 フィクスチャ生成
+def generate_rows(count: int, month: str = '2025-01', seed: int = 0):
+    """チップ履歴テーブルの <tr> を生成"""
+    rnd = random.Random(seed)
+    balance = 100000
+    rows = []
+    for i in range(count):
+        ring = rnd.randint(-20000, 20000)
+        tournament = rnd.randint(-5000, 15000)
+        purchase = rnd.choice([0, 0, 0, 10000])
+        balance += ring + tournament + purchase
+        day = 28 - (i * 28 // max(count, 1))
+        rows.append(
+            f'<tr><td>{month}-{day:02d} {18 + i % 6}:00</td>'
+            f'<td>{ring:,}</td><td>{tournament:,}</td><td>{purchase:,}</td>'
+            f'<td>{ring + tournament:+,}</td><td>{balance:,}</td>'
+            f'<td>{STORES[i % len(STORES)]}</td></tr>'
+        )
+    return ''.join(rows)
+
+def generate_page(row_count: int, seed: int = 0) -> str:
+    """上流サイトと同程度のヘッダー・ナビゲーションを持つページを生成"""
+    head = (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>チップ履歴</title>'
+        + '<script>window.dataLayer = window.dataLayer || []; var t = "<table>";</script>' * 3
+        + '<link rel="stylesheet" href="/assets/application.css">' * 5
+        + '</head><body>'
+    )
+    nav = '<nav><ul>' + '<li><a href="/players/x">メニュー</a></li>' * 40 + '</ul></nav>'
+    select = '<select name="store_id">' + ''.join(
+        f'<option value="{i}">{name}</option>' for i, name in enumerate(STORES, start=6)
+    ) + '</select>'
+    table = (
+        '<table class="table"><thead><tr><th>日付</th><th>リング</th><th>トーナメント</th>'
+        '<th>購入</th><th>合計</th><th>残高</th><th>店舗</th></tr></thead>'
+        f'<tbody>{generate_rows(row_count, seed=seed)}</tbody></table>'
+    )
+    footer = '<footer>' + '<p>&copy; jyanken poker</p>' * 10 + '</footer>'
+    return head + nav + select + table + footer + '</body></html>'
+
+def generate_month_results(months: int = 24, rows_per_month: int = 17):
+    """バッチ取得の結果（月ごとの行リスト）を生成"""
+    results = []
+    for index in range(months):
+        month = f'{2024 + index // 12}-{index % 12 + 1:02d}'
+        html = f'<table><tbody>{generate_rows(rows_per_month, month=month, seed=index)}</tbody></table>'
+        results.append(server.parse_chip_history_soup(html))
+    return results
+
+# ⏱️ 計測
+def measure(func, min_time: float = 0.2) -> dict:
+    """ops/sec と1回あたりのピークメモリを計測"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    repeats = max(1, int(min_time / max(timer.timeit(number) / number, 1e-9) / number))
+    best = min(timer.repeat(repeat=3, number=number * repeats)) / (number * repeats)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'ops_per_sec': round(1 / best, 1), 'peak_bytes': peak}
+
+def build_cases():
+    """ベンチマーク対象の一覧"""
+    cases = {}
+
+    for row_count in (10, 100, 1000):
+        page = generate_page(row_count, seed=row_count)
+        cases[f'parse_chip_history[{row_count}]'] = lambda page=page: server.parse_chip_history(page)
+        cases[f'parse_chip_history_soup[{row_count}]'] = lambda page=page: server.parse_chip_history_soup(page)
+
+    cases['validate_email'] = lambda: server.validate_email('player.name+tag@example.co.jp')
+    cases['validate_month'] = lambda: server.validate_month('2025-12')
+
+    for months, rows_per_month in ((24, 17), (24, 200)):
+        results = generate_month_results(months, rows_per_month)
+        row_count = sum(map(len, results))
+        cases[f'dedupe_and_sort_rows[{row_count}]'] = lambda results=results: server.dedupe_and_sort_rows(results)
+
+    app = server.create_app()
+    for row_count in (408, 4800):
+        data = [row for rows in generate_month_results(24, row_count // 24) for row in rows]
+
+        def run_jsonify(data=data):
+            with app.app_context():
+                server.jsonify({'success': True, 'data': data}).get_data()
+        cases[f'jsonify[{row_count}]'] = run_jsonify
+        cases[f'dumps_json[{row_count}]'] = lambda data=data: server.dumps_json({'success': True, 'data': data})
+        cases[f'dumps_json_columnar[{row_count}]'] = lambda data=data: server.dumps_json(
+            {'success': True, 'data': server.to_columnar(data)}
+        )
+
+    return cases
+
+def check_parser_equivalence(page_dir=None) -> int:
+    """生成ページ（と保存済みページ）で高速パーサーとフォールバックを比較"""
+    pages = {f'generated[{n}]': generate_page(n, seed=n) for n in (0, 1, 10, 100, 1000)}
+    if page_dir:
+        for name in sorted(os.listdir(page_dir)):
+            if name.endswith(('.html', '.htm')):
+                with open(os.path.join(page_dir, name), encoding='utf-8') as f:
+                    pages[name] = f.read()
+
+    mismatches = [name for name, html in pages.items() if not server.compare_parsers(html)]
+    for name in mismatches:
+        print(f'❌ parser mismatch: {name}')
+    print(f'✅ parser equivalence: {len(pages) - len(mismatches)}/{len(pages)} pages')
+    return len(mismatches)
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> int:
+    """ベースラインとの差分を表示し、閾値を超えた劣化の件数を返す"""
+    regressions = 0
+    print(f'{"benchmark":<36}{"ops/sec":>14}{"baseline":>14}{"diff":>9}{"peak KiB":>11}')
+    for name, result in results.items():
+        base = baseline.get(name)
+        ops = result['ops_per_sec']
+        peak_kib = result['peak_bytes'] / 1024
+        if base:
+            diff = (ops - base['ops_per_sec']) / base['ops_per_sec'] * 100
+            marker = ' ⚠️' if diff < -threshold else ''
+            regressions += diff < -threshold
+            print(f'{name:<36}{ops:>14,.1f}{base["ops_per_sec"]:>14,.1f}{diff:>+8.1f}%{peak_kib:>11,.1f}{marker}')
+        else:
+            print(f'{name:<36}{ops:>14,.1f}{"-":>14}{"-":>9}{peak_kib:>11,.1f}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save-baseline', action='store_true', help='結果をベースラインとして保存')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='ベースラインJSONのパス')
+    parser.add_argument('--threshold', type=float, default=20.0, help='劣化とみなす ops/sec の低下率 (%%)')
+    parser.add_argument('--filter', default='', help='名前に含まれる文字列で対象を絞り込む')
+    parser.add_argument('--pages', default=PAGES_DIR, help='差分検証に使う保存済みHTMLのディレクトリ')
+    args = parser.parse_args()
+
+    failures = check_parser_equivalence(args.pages)
+
+    results = {}
+    for name, func in build_cases().items():
+        if args.filter in name:
+            results[name] = measure(func)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False, sort_keys=True)
+            f.write('\n')
+        print(f'💾 baseline saved: {args.baseline}')
+        return 1 if failures else 0
+
+    return 1 if failures or regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
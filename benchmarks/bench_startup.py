@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Startup-time benchmark for combined_server.py (cold start)
+
+新しいPythonプロセスで import → create_app() → 最初のリクエスト までの時間を計測する。
+
+使い方:
+    python benchmarks/bench_startup.py             # 5回計測して中央値を表示
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --importtime  # 遅いモジュールの上位を表示
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行する計測スクリプト（時刻は perf_counter の差分、単位ms）
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import combined_server as server
+imported = time.perf_counter()
+app = server.create_app()
+created = time.perf_counter()
+client = app.test_client()
+client.get('/')
+first_page = time.perf_counter()
+client.get('/proxy/api/cache_stats', headers={'Authorization': 'Bearer bench'})
+first_api = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_page_ms': (first_page - created) * 1000,
+    'first_api_ms': (first_api - first_page) * 1000,
+}))
+'''
+
+def probe_env() -> dict:
+    """ディスクへの永続化を行わない環境変数"""
+    env = dict(os.environ)
+    env.setdefault('CHIP_STORE_PATH', '')
+    env.setdefault('STATIC_CACHE_DIR', '')
+    env.setdefault('WEB_DIR', os.path.join(ROOT_DIR, 'build', 'web'))
+    env['METRICS_TOKEN'] = 'bench'
+    env['PYTHONPATH'] = ROOT_DIR
+    return env
+
+def run_probe() -> dict:
+    """新しいプロセスで1回計測（プロセス起動を含む全体時間も記録）"""
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE],
+        env=probe_env(), capture_output=True, text=True, check=True
+    ).stdout
+    total_ms = (time.perf_counter() - started) * 1000
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_total_ms'] = total_ms
+    return result
+
+def show_importtime(top: int):
+    """python -X importtime の累積時間が大きいモジュールを表示"""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import combined_server'],
+        env=probe_env(), capture_output=True, text=True, check=True
+    ).stderr
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        entries.append((int(cumulative_us), int(self_us), name))
+    print(f'{"module":<40}{"cumulative ms":>15}{"self ms":>10}')
+    for cumulative_us, self_us, name in sorted(entries, reverse=True)[:top]:
+        print(f'{name.strip():<40}{cumulative_us / 1000:>15,.1f}{self_us / 1000:>10,.1f}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='計測回数')
+    parser.add_argument('--importtime', action='store_true', help='import に時間がかかるモジュールを表示')
+    parser.add_argument('--top', type=int, default=15, help='--importtime で表示する件数')
+    args = parser.parse_args()
+
+    if args.importtime:
+        show_importtime(args.top)
+        return 0
+
+    results = [run_probe() for _ in range(args.runs)]
+    print(f'{"phase":<20}{"median ms":>12}{"min ms":>10}{"max ms":>10}')
+    for phase in ('import_ms', 'create_app_ms', 'first_page_ms', 'first_api_ms', 'process_total_ms'):
+        values = [result[phase] for result in results]
+        print(f'{phase:<20}{statistics.median(values):>12,.1f}{min(values):>10,.1f}{max(values):>10,.1f}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
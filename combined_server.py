@@ -3,20 +3,60 @@
 Combined server: Flutter Web + Proxy API (Security Enhanced)
 """
 
-from flask import Flask, send_from_directory, request, jsonify
+from flask import Blueprint, Flask, Response, g, send_file, send_from_directory, request, jsonify
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits.storage import Storage
 import requests
-from bs4 import BeautifulSoup
 import re
 import os
+import bisect
+import heapq
+import contextvars
+import weakref
+import mimetypes
+import stat
+import tempfile
 import secrets
 import hashlib
+import csv
+import io
+import json
+import random
+import sqlite3
 import time
+import sys
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from itertools import accumulate, chain, count, islice, pairwise
+from operator import itemgetter
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import logging
+import asyncio
+
+import gzip
+
+try:
+    import orjson
+except ImportError:  # 標準の json で代替
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # MessagePack 応答を無効化
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # gzip のみで圧縮
+    brotli = None
 
 # ロギング設定
 logging.basicConfig(
@@ -25,85 +65,864 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-
-# 🔒 セキュリティ設定
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
-app.config['SESSION_COOKIE_SECURE'] = True  # HTTPS only
-app.config['SESSION_COOKIE_HTTPONLY'] = True  # XSS対策
-app.config['SESSION_COOKIE_SAMESITE'] = 'Strict'  # CSRF対策
-
 # 🔒 CORS設定（特定のオリジンのみ許可）
 # 開発中は緩和、本番環境では厳格化推奨
 DEV_MODE = os.environ.get('DEV_MODE', 'true').lower() == 'true'
 
-if DEV_MODE:
-    # 開発モード: すべてのVercelドメインとサンドボックスを許可
-    CORS(app, 
-         resources={r"/*": {
-             "origins": "*",  # 開発中は全許可
-             "methods": ["GET", "POST", "OPTIONS"],
-             "allow_headers": ["Content-Type", "X-Session-ID"],
-             "expose_headers": ["Content-Type"],
-             "supports_credentials": False,  # *を使う場合はFalse必須
-             "max_age": 3600
-         }})
-    logger.info("🔓 CORS: Development mode - all origins allowed")
-else:
-    # 本番モード: 特定のオリジンのみ
-    ALLOWED_ORIGINS = [
-        'https://5060-imv460mslw8g37var1eds-3844e1b6.sandbox.novita.ai',
-        'https://junpo-analyze.vercel.app',
-        'http://localhost:5060',
-    ]
-    CORS(app, 
-         resources={r"/*": {
-             "origins": ALLOWED_ORIGINS,
-             "methods": ["GET", "POST", "OPTIONS"],
-             "allow_headers": ["Content-Type", "X-Session-ID"],
-             "expose_headers": ["Content-Type"],
-             "supports_credentials": True,
-             "max_age": 3600
-         }})
-    logger.info(f"🔒 CORS: Production mode - allowed origins: {ALLOWED_ORIGINS}")
-
-# 🔒 レート制限設定
+# 本番モードで許可するオリジン
+ALLOWED_ORIGINS = [
+    'https://5060-imv460mslw8g37var1eds-3844e1b6.sandbox.novita.ai',
+    'https://junpo-analyze.vercel.app',
+    'http://localhost:5060',
+]
+
+# ルートは create_app() で登録する
+routes = Blueprint('combined_server', __name__)
+
+# 📈 メトリクス（Prometheus テキスト形式で /metrics に出力）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+FANOUT_BUCKETS = (1, 2, 3, 6, 12, 24, 48, 72, 120)
+# 🔒 /metrics と統計API（cache_stats / upstream_stats）には Authorization: Bearer <token> が必要（未設定なら無効）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+def format_labels(names, values) -> str:
+    """Prometheus のラベル表記 {a="x",b="y"}"""
+    if not names:
+        return ''
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in values
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class ShardedMetric:
+    """スレッドごとの集計表に記録し、出力時に合算するメトリクス
+
+    記録時はロックを取らない（スレッドの初回記録と終了時の集約だけロック）。
+    """
+    kind = None
+    
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.shards = {}   # id(shard) -> {labels: [値...]}
+        self.retired = {}  # 終了したスレッドの集計
+        self.lock = threading.Lock()
+    
+    def _shard(self) -> dict:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards[id(shard)] = shard
+            # リクエストごとにスレッドを作るサーバーでも集計表が増え続けないように統合
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+            return shard
+    
+    def _retire(self, shard: dict):
+        with self.lock:
+            self.shards.pop(id(shard), None)
+            self._merge_into(self.retired, shard)
+    
+    @staticmethod
+    def _merge_into(target: dict, shard: dict):
+        for labels, values in list(shard.items()):
+            merged = target.get(labels)
+            if merged is None:
+                target[labels] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    merged[i] += value
+    
+    def collect(self) -> dict:
+        """全スレッドの集計を合算した {labels: [値...]}"""
+        merged = {}
+        with self.lock:
+            self._merge_into(merged, self.retired)
+            shards = list(self.shards.values())
+        for shard in shards:
+            self._merge_into(merged, shard)
+        return merged
+    
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for labels, values in sorted(self.collect().items()):
+            lines.extend(self.render_values(labels, values))
+        return lines
+
+class Counter(ShardedMetric):
+    """単調増加するカウンタ"""
+    kind = 'counter'
+    
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        values = shard.get(labels)
+        if values is None:
+            values = shard[labels] = [0]
+        values[0] += amount
+    
+    def render_values(self, labels, values) -> list:
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {values[0]}']
+
+class Histogram(ShardedMetric):
+    """バケットごとの件数と合計を持つヒストグラム"""
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        values = shard.get(labels)
+        if values is None:
+            # [各バケットの件数..., +Infの件数, 合計]
+            values = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+    
+    def render_values(self, labels, values) -> list:
+        names = self.labelnames + ('le',)
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), values[:-1]):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{format_labels(names, (*labels, bound))} {cumulative}')
+        lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {values[-1]}')
+        lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+class Gauge:
+    """出力時に関数を呼んで値を得るゲージ"""
+    def __init__(self, name: str, help_text: str, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+    
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge', f'{self.name} {self.func()}']
+
+class MetricsRegistry:
+    """メトリクスの一覧"""
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+    
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+    
+    def gauge(self, name: str, help_text: str, func) -> Gauge:
+        return self.register(Gauge(name, help_text, func))
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} failed: {sanitize_error_message(e)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+request_latency = metrics.histogram(
+    'junpo_http_request_duration_seconds', 'リクエスト処理時間（秒）', ('endpoint', 'method')
+)
+request_count = metrics.counter(
+    'junpo_http_requests_total', 'レスポンス数', ('endpoint', 'status')
+)
+rate_limited_count = metrics.counter(
+    'junpo_rate_limited_total', 'レート制限で拒否したリクエスト数', ('endpoint',)
+)
+upstream_latency = metrics.histogram(
+    'junpo_upstream_request_duration_seconds', '上流サイトへのリクエスト時間（秒）', ('path',)
+)
+upstream_responses = metrics.counter(
+    'junpo_upstream_responses_total', '上流サイトの応答数（ステータス別、timeout/error含む）', ('path', 'status')
+)
+upstream_queue_wait = metrics.histogram(
+    'junpo_upstream_queue_wait_seconds', '上流リクエストのスケジューラ待ち時間（秒）'
+)
+parse_latency = metrics.histogram(
+    'junpo_parse_duration_seconds', 'チップ履歴ページのパース時間（秒）', ('parser',)
+)
+parse_rows = metrics.histogram(
+    'junpo_parse_rows', '1ページあたりの行数', buckets=ROW_COUNT_BUCKETS
+)
+encode_latency = metrics.histogram(
+    'junpo_encode_duration_seconds', '応答本文のシリアライズ時間（秒）', ('format',)
+)
+upstream_retries = metrics.counter(
+    'junpo_upstream_retries_total', '一時的なエラーによる上流リクエストの再試行数'
+)
+upstream_hedges = metrics.counter(
+    'junpo_upstream_hedges_total', '遅い上流リクエストに追加で送ったヘッジ要求の数'
+)
+batch_fanout = metrics.histogram(
+    'junpo_batch_fanout', 'バッチ1回あたりの (店舗, 月) の数', buckets=FANOUT_BUCKETS
+)
+
+def record_upstream_call(url: str, status: str, seconds: float):
+    """上流リクエスト1回分の時間と結果を記録"""
+    path = urlsplit(url).path
+    upstream_latency.observe(seconds, path)
+    upstream_responses.inc(path, status)
+
+def record_rate_limit_breach(request_limit):
+    """レート制限超過時に呼ばれる（応答はFlask-Limiterの既定のまま）"""
+    rate_limited_count.inc((request.endpoint or 'unmatched').rsplit('.', 1)[-1])
+
+# 🔍 リクエストトレース（管理者ヘッダーまたはサンプリングで有効化）
+TRACE_ADMIN_TOKEN = os.environ.get('TRACE_ADMIN_TOKEN', '')  # X-Trace-Token ヘッダーと一致すればトレース
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))  # 通常リクエストをトレースする割合
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', '100'))
+PROFILE_INTERVAL = 0.005  # CPUプロファイルの採取間隔（秒）
+PROFILE_IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py', 'socketserver.py', 'base_events.py')  # CPU時間が取れない環境用
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """トレースの1区間（子区間を持つ）"""
+    __slots__ = ('name', 'attrs', 'started', 'ended', 'children', 'thread')
+    
+    def __init__(self, name: str, attrs: dict, started: float = None):
+        self.name = name
+        self.attrs = attrs
+        self.started = started if started is not None else time.perf_counter()
+        self.ended = None
+        self.children = []
+        self.thread = threading.current_thread().name
+    
+    def duration(self) -> float:
+        return (self.ended or time.perf_counter()) - self.started
+    
+    def to_dict(self, origin: float) -> dict:
+        return {
+            'name': self.name,
+            'attrs': self.attrs,
+            'thread': self.thread,
+            'start_ms': round((self.started - origin) * 1000, 3),
+            'duration_ms': round(self.duration() * 1000, 3),
+            'children': [child.to_dict(origin) for child in list(self.children)],
+        }
+    
+    def collapsed(self, prefix: str = '', lines: list = None) -> list:
+        """flamegraph.pl 形式（"親;子 自己時間µs"）の行"""
+        lines = [] if lines is None else lines
+        path = f'{prefix};{self.name}' if prefix else self.name
+        children = list(self.children)
+        # 並列に動いた子の合計が親を超える場合は自己時間0とする
+        self_us = int((self.duration() - sum(child.duration() for child in children)) * 1e6)
+        if self_us > 0:
+            lines.append(f'{path} {self_us}')
+        for child in children:
+            child.collapsed(path, lines)
+        return lines
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """トレース中なら現在の区間の子として区間を記録（トレースしていなければ何もしない）"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(name, attrs)
+    parent.children.append(span)
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        span.ended = time.perf_counter()
+        current_span.reset(token)
+
+def record_span(name: str, started: float, **attrs):
+    """計測済みの区間を現在の区間の子として追加（トレース中のみ）"""
+    parent = current_span.get()
+    if parent is not None:
+        span = Span(name, attrs, started)
+        span.ended = time.perf_counter()
+        parent.children.append(span)
+
+class SamplingProfiler:
+    """リクエスト処理中の全スレッドのスタックを一定間隔で採取
+    
+    プロセス全体が対象なので同時に動いている他のリクエストも含まれる。
+    負荷を抑えるため同時に1つだけ動かす。
+    """
+    running = threading.Lock()
+    
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = {}  # "スレッド;関数;..." -> 回数
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def start(self) -> bool:
+        if not SamplingProfiler.running.acquire(blocking=False):
+            return False
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        SamplingProfiler.running.release()
+    
+    @staticmethod
+    def thread_cpu_time(ident: int):
+        """スレッドのCPU時間（Linux以外などで取れない場合はNone）"""
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return None
+    
+    def is_idle(self, ident: int, frame, cpu_times: dict) -> bool:
+        """前回の採取からCPUを使っていないスレッドか"""
+        cpu_time = self.thread_cpu_time(ident)
+        if cpu_time is None:
+            return os.path.basename(frame.f_code.co_filename) in PROFILE_IDLE_FILES
+        previous = cpu_times.get(ident)
+        cpu_times[ident] = cpu_time
+        return previous is not None and cpu_time == previous
+    
+    def _run(self):
+        own_ident = threading.get_ident()
+        cpu_times = {}
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                # 待機中のスレッドはCPUを使っていないので数えない
+                if ident == own_ident or self.is_idle(ident, frame, cpu_times):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                thread_name = names.get(ident, 'thread').split(' ')[0].rstrip('0123456789-_') or 'thread'
+                key = ';'.join([thread_name, *reversed(stack)])
+                self.samples[key] = self.samples.get(key, 0) + 1
+    
+    def collapsed(self) -> list:
+        return [f'{stack} {count}' for stack, count in sorted(self.samples.items())]
+
+class TraceBuffer:
+    """直近のトレースを保持するリングバッファ"""
+    def __init__(self, size: int):
+        self.traces = deque(maxlen=size)
+    
+    def add(self, trace: dict):
+        self.traces.append(trace)
+    
+    def summaries(self) -> list:
+        return [
+            {key: trace[key] for key in ('id', 'started_at', 'endpoint', 'method', 'path', 'status', 'duration_ms')}
+            for trace in reversed(list(self.traces))
+        ]
+    
+    def get(self, trace_id: str):
+        return next((trace for trace in list(self.traces) if trace['id'] == trace_id), None)
+
+trace_buffer = TraceBuffer(TRACE_BUFFER_SIZE)
+
+# 💾 SQLite接続（ワーカープロセスごとに接続を張り直す）
+class SQLiteDatabase:
+    """pre-fork で複数ワーカーから共有できるSQLite(WAL)データベース
+
+    接続はプロセスごとに生成し（fork後に親の接続を使わない）、
+    プロセス内ではロックで直列化する。
+    """
+    def __init__(self, path: str, schema: str, private: bool = False):
+        self.path = path
+        self.schema = schema
+        self.private = private
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+    
+    def _connection(self):
+        # self.lock を保持した状態で呼ぶ
+        if self.conn is None or self.pid != os.getpid():
+            # 🔒 認証情報を含むファイルは所有者のみ読み書き可能にする
+            # （接続前に 0600 で作成すると、SQLite は -wal / -shm も同じ権限で作る）
+            if self.private:
+                try:
+                    os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+                    os.chmod(self.path, 0o600)
+                except OSError as e:
+                    # 呼び出し側は sqlite3.Error だけを扱うので、開けない場合と同じ例外にそろえる
+                    raise sqlite3.OperationalError(f'unable to open database file: {e.strerror}') from e
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.schema)
+            self.pid = os.getpid()
+            # 以前の起動で作られた -wal / -shm の権限も直す
+            if self.private:
+                for suffix in ('-wal', '-shm'):
+                    if os.path.exists(self.path + suffix):
+                        os.chmod(self.path + suffix, 0o600)
+        return self.conn
+    
+    def execute(self, sql: str, params=()) -> list:
+        """1文を実行して全行を返す（自動コミット）"""
+        with self.lock:
+            return self._connection().execute(sql, params).fetchall()
+    
+    @contextmanager
+    def transaction(self):
+        """書き込みロックを取得したトランザクション（読み取り→更新を原子的に行う）"""
+        with self.lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+# 🔒 レート制限カウンタの共有ストレージ（RATELIMIT_STORAGE_URI=sqlite:////path/to/ratelimit.db）
+class SQLiteLimiterStorage(Storage):
+    """同一ホスト上の複数ワーカーでレート制限カウンタを共有する固定ウィンドウ用ストレージ"""
+    STORAGE_SCHEME = ['sqlite']
+    
+    def __init__(self, uri: str = None, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.db = SQLiteDatabase(uri[len('sqlite://'):], '''
+            CREATE TABLE IF NOT EXISTS counters (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        ''')
+    
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+    
+    def incr(self, key: str, expiry: float, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT value, expires_at FROM counters WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires_at = amount, now + expiry
+            else:
+                value = row[0] + amount
+                expires_at = now + expiry if elastic_expiry else row[1]
+            conn.execute(
+                'INSERT OR REPLACE INTO counters (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, expires_at)
+            )
+            # 期限切れのカウンタをときどき掃除
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM counters WHERE expires_at <= ?', (now,))
+        return value
+    
+    def get(self, key: str) -> int:
+        rows = self.db.execute(
+            'SELECT value FROM counters WHERE key = ? AND expires_at > ?', (key, time.time())
+        )
+        return rows[0][0] if rows else 0
+    
+    def get_expiry(self, key: str) -> float:
+        rows = self.db.execute(
+            'SELECT expires_at FROM counters WHERE key = ? AND expires_at > ?', (key, time.time())
+        )
+        return rows[0][0] if rows else time.time()
+    
+    def check(self) -> bool:
+        try:
+            self.db.execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+    
+    def reset(self):
+        with self.db.transaction() as conn:
+            return conn.execute('DELETE FROM counters').rowcount
+    
+    def clear(self, key: str) -> None:
+        self.db.execute('DELETE FROM counters WHERE key = ?', (key,))
+
+# 🔒 レート制限設定（複数ワーカーで共有する場合は sqlite:// 等を指定）
+RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+
 limiter = Limiter(
-    app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"
+    storage_uri=RATELIMIT_STORAGE_URI,
+    on_breach=record_rate_limit_breach
 )
 
+# 🔒 バッチ取得で一度に指定できる店舗数の上限
+MAX_BATCH_STORES = 5
+
 # Flutter web build directory
-WEB_DIR = '/home/user/flutter_app/build/web'
+WEB_DIR = os.environ.get('WEB_DIR', '/home/user/flutter_app/build/web')
 BASE_URL = 'https://jyanken-poker.onrender.com'
 
+# 🔒 セッション保存先の設定: 'memory'（単一プロセス）または 'sqlite'（複数ワーカー・再起動後も共有）
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.environ.get(
+    'SESSION_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.db')
+)
+SESSION_MAX_COUNT = int(os.environ.get('SESSION_MAX_COUNT', '10000'))  # 超えたら最も古いものから破棄
+SESSION_CLEANUP_INTERVAL = int(os.environ.get('SESSION_CLEANUP_INTERVAL', '60'))  # 秒
+SESSION_OVERHEAD_BYTES = 4096  # requests.Session 1つあたりのおおよその常駐サイズ
+
+def dump_cookies(jar) -> str:
+    """CookieJar をJSON文字列に変換（内容が同じなら同じ文字列）"""
+    cookies = [
+        {
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'secure': cookie.secure,
+            'expires': cookie.expires,
+            'rest': cookie._rest,
+        }
+        for cookie in jar
+    ]
+    cookies.sort(key=lambda c: (c['domain'], c['path'], c['name']))
+    return json.dumps(cookies, separators=(',', ':'))
+
+def load_cookies(jar, data: str):
+    """dump_cookies の結果を CookieJar に読み込む（既存のCookieは破棄）"""
+    jar.clear()
+    for cookie in json.loads(data):
+        jar.set_cookie(requests.cookies.create_cookie(**cookie))
+
+# 🔒 セッション保存先のインターフェース
+class SessionBackend(ABC):
+    """セッション情報（session_data辞書）の保存先
+
+    session_data: session_id / session（requests.Session）/ email_hash /
+    created_at / last_accessed
+    """
+    @abstractmethod
+    def get(self, session_id: str):
+        """session_data を取得（無ければNone）"""
+    
+    @abstractmethod
+    def save(self, session_data: dict):
+        """新しいセッションを保存"""
+    
+    @abstractmethod
+    def touch(self, session_data: dict):
+        """最終アクセス時刻・Cookieの更新を反映"""
+    
+    @abstractmethod
+    def save_cookies(self, session_data: dict):
+        """上流の応答で更新されたCookieを保存"""
+    
+    @abstractmethod
+    def delete(self, session_id: str) -> bool:
+        """セッションを削除（存在した場合True）"""
+    
+    @abstractmethod
+    def expired_ids(self, cutoff: datetime) -> list:
+        """cutoff より前から使われていないセッションID"""
+    
+    @abstractmethod
+    def count(self) -> int:
+        """保存中のセッション数"""
+    
+    @abstractmethod
+    def stats(self) -> dict:
+        """セッション数・おおよそのメモリ使用量などのゲージ"""
+
+def cookie_jar_bytes(jar) -> int:
+    """CookieJar のおおよそのサイズ"""
+    return sum(len(cookie.name) + len(cookie.value or '') for cookie in jar)
+
+class MemorySessionBackend(SessionBackend):
+    """プロセス内に保存（単一プロセス向け・再起動で消える）
+
+    最終アクセス順の OrderedDict で保持し、期限切れは先頭から、
+    上限超過は最も長く使われていないものから取り除く。
+    """
+    def __init__(self, max_sessions: int = SESSION_MAX_COUNT):
+        self.sessions = OrderedDict()  # session_id -> session_data（古い順）
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.evictions = 0
+    
+    def get(self, session_id: str):
+        with self.lock:
+            return self.sessions.get(session_id)
+    
+    def save(self, session_data: dict):
+        evicted = []
+        with self.lock:
+            self.sessions[session_data['session_id']] = session_data
+            self.sessions.move_to_end(session_data['session_id'])
+            while len(self.sessions) > self.max_sessions:
+                evicted.append(self.sessions.popitem(last=False)[1])
+            self.evictions += len(evicted)
+        for old in evicted:
+            old['session'].close()
+            logger.info(f"Session evicted (capacity): {old['session_id'][:8]}...")
+    
+    def touch(self, session_data: dict):
+        # 同じ辞書オブジェクトを保持しているので並び順だけ更新
+        with self.lock:
+            if session_data['session_id'] in self.sessions:
+                self.sessions.move_to_end(session_data['session_id'])
+    
+    def save_cookies(self, session_data: dict):
+        # 同じ requests.Session を保持しているので保存するものはない
+        pass
+    
+    def delete(self, session_id: str) -> bool:
+        with self.lock:
+            session_data = self.sessions.pop(session_id, None)
+        if session_data is None:
+            return False
+        session_data['session'].close()
+        return True
+    
+    def expired_ids(self, cutoff: datetime) -> list:
+        # ⚡ 先頭（最も古いもの）から期限内のセッションに当たるまでだけ見る
+        expired = []
+        with self.lock:
+            for sid, data in self.sessions.items():
+                if data['last_accessed'] >= cutoff:
+                    break
+                expired.append(sid)
+        return expired
+    
+    def count(self) -> int:
+        with self.lock:
+            return len(self.sessions)
+    
+    def stats(self) -> dict:
+        with self.lock:
+            sessions = list(self.sessions.values())
+            evictions = self.evictions
+        return {
+            'backend': 'memory',
+            'sessions': len(sessions),
+            'max_sessions': self.max_sessions,
+            'evictions': evictions,
+            'approx_bytes': sum(
+                SESSION_OVERHEAD_BYTES + cookie_jar_bytes(data['session'].cookies) for data in sessions
+            ),
+        }
+
+class SQLiteSessionBackend(SessionBackend):
+    """SQLite(WAL)にセッションと上流のCookieJarを保存
+
+    同一ホストの複数ワーカーで共有でき、再起動後もログイン状態が残る。
+    requests.Session はプロセスごとにCookieから復元してキャッシュする。
+    """
+    TOUCH_INTERVAL = 30  # 最終アクセス時刻を書き込む最小間隔（秒）
+    
+    def __init__(self, path: str, max_sessions: int = SESSION_MAX_COUNT):
+        self.db = SQLiteDatabase(path, '''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                email_hash TEXT NOT NULL,
+                cookies TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_last_accessed ON sessions (last_accessed);
+        ''', private=True)
+        self.live = OrderedDict()  # session_id -> session_data（このプロセスで復元したもの、古い順）
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.evictions = 0
+    
+    def get(self, session_id: str):
+        rows = self.db.execute(
+            'SELECT email_hash, cookies, created_at, last_accessed FROM sessions WHERE session_id = ?',
+            (session_id,)
+        )
+        with self.lock:
+            if not rows:
+                self.live.pop(session_id, None)
+                return None
+            email_hash, cookies, created_at, last_accessed = rows[0]
+            
+            session_data = self.live.get(session_id)
+            if session_data is None:
+                session_data = self.live[session_id] = {
+                    'session_id': session_id,
+                    'session': new_upstream_session(),
+                    'email_hash': email_hash,
+                    'created_at': datetime.fromtimestamp(created_at),
+                    'last_accessed': datetime.fromtimestamp(last_accessed),
+                    '_persisted_cookies': None,
+                    '_persisted_at': last_accessed,
+                }
+            
+            # 他のワーカーが更新したCookie・アクセス時刻を反映
+            if cookies != session_data['_persisted_cookies']:
+                load_cookies(session_data['session'].cookies, cookies)
+                session_data['_persisted_cookies'] = cookies
+            session_data['last_accessed'] = max(
+                session_data['last_accessed'], datetime.fromtimestamp(last_accessed)
+            )
+            self.live.move_to_end(session_id)
+            evicted = self._trim_live()
+        for old in evicted:
+            old['session'].close()
+        return session_data
+    
+    def _trim_live(self) -> list:
+        # self.lock を保持した状態で呼ぶ（Cookieから復元できるので閉じるだけでよい）
+        evicted = []
+        while len(self.live) > self.max_sessions:
+            evicted.append(self.live.popitem(last=False)[1])
+        return evicted
+    
+    def save(self, session_data: dict):
+        cookies = dump_cookies(session_data['session'].cookies)
+        last_accessed = session_data['last_accessed'].timestamp()
+        self.db.execute(
+            'INSERT OR REPLACE INTO sessions (session_id, email_hash, cookies, created_at, last_accessed) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (session_data['session_id'], session_data['email_hash'], cookies,
+             session_data['created_at'].timestamp(), last_accessed)
+        )
+        session_data['_persisted_cookies'] = cookies
+        session_data['_persisted_at'] = last_accessed
+        
+        # 上限を超えたら最も長く使われていないセッションから破棄
+        with self.db.transaction() as conn:
+            evicted_ids = [row[0] for row in conn.execute(
+                'SELECT session_id FROM sessions ORDER BY last_accessed DESC LIMIT -1 OFFSET ?',
+                (self.max_sessions,)
+            )]
+            conn.executemany('DELETE FROM sessions WHERE session_id = ?', [(sid,) for sid in evicted_ids])
+        
+        with self.lock:
+            self.live[session_data['session_id']] = session_data
+            evicted = [self.live.pop(sid) for sid in evicted_ids if sid in self.live]
+            evicted.extend(self._trim_live())
+            self.evictions += len(evicted_ids)
+        for old in evicted:
+            old['session'].close()
+        for sid in evicted_ids:
+            logger.info(f"Session evicted (capacity): {sid[:8]}...")
+    
+    def touch(self, session_data: dict):
+        cookies = dump_cookies(session_data['session'].cookies)
+        last_accessed = session_data['last_accessed'].timestamp()
+        # ⚡ Cookieが変わらない限り書き込みは間引く
+        if (cookies == session_data['_persisted_cookies']
+                and last_accessed - session_data['_persisted_at'] < self.TOUCH_INTERVAL):
+            return
+        self.db.execute(
+            'UPDATE sessions SET cookies = ?, last_accessed = MAX(last_accessed, ?) WHERE session_id = ?',
+            (cookies, last_accessed, session_data['session_id'])
+        )
+        session_data['_persisted_cookies'] = cookies
+        session_data['_persisted_at'] = last_accessed
+        with self.lock:
+            if session_data['session_id'] in self.live:
+                self.live.move_to_end(session_data['session_id'])
+    
+    def save_cookies(self, session_data: dict):
+        cookies = dump_cookies(session_data['session'].cookies)
+        if cookies == session_data['_persisted_cookies']:
+            return
+        # 取得結果は返せるので、保存できなくても次回の touch で再試行する
+        try:
+            self.db.execute(
+                'UPDATE sessions SET cookies = ? WHERE session_id = ?',
+                (cookies, session_data['session_id'])
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Session cookie write failed: {type(e).__name__}")
+            return
+        session_data['_persisted_cookies'] = cookies
+    
+    def delete(self, session_id: str) -> bool:
+        with self.db.transaction() as conn:
+            deleted = conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,)).rowcount
+        with self.lock:
+            session_data = self.live.pop(session_id, None)
+        if session_data is not None:
+            session_data['session'].close()
+        return bool(deleted) or session_data is not None
+    
+    def expired_ids(self, cutoff: datetime) -> list:
+        rows = self.db.execute(
+            'SELECT session_id FROM sessions WHERE last_accessed < ?', (cutoff.timestamp(),)
+        )
+        expired = {row[0] for row in rows}
+        # 他のワーカーが削除済みのセッションもこのプロセスのキャッシュから外す
+        with self.lock:
+            for sid, data in self.live.items():
+                if data['last_accessed'] >= cutoff:
+                    break
+                expired.add(sid)
+        return list(expired)
+    
+    def count(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM sessions')[0][0]
+    
+    def stats(self) -> dict:
+        count, cookie_bytes = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(cookies)), 0) FROM sessions'
+        )[0]
+        with self.lock:
+            live = len(self.live)
+            evictions = self.evictions
+        return {
+            'backend': 'sqlite',
+            'sessions': count,
+            'live_sessions': live,
+            'max_sessions': self.max_sessions,
+            'evictions': evictions,
+            'approx_bytes': live * SESSION_OVERHEAD_BYTES,
+            'stored_cookie_bytes': cookie_bytes,
+        }
+
 # 🔒 セキュアなセッション管理
 class SecureSessionManager:
-    def __init__(self):
-        self.sessions = {}
+    def __init__(self, backend: SessionBackend = None):
+        self.backend = backend or MemorySessionBackend()
         self.session_timeout = timedelta(hours=2)  # 2時間でタイムアウト
     
-    def create_session(self, email: str) -> str:
+    def create_session(self, email: str, upstream_session=None) -> str:
         """セキュアなセッションIDを生成"""
         session_id = secrets.token_urlsafe(32)
-        self.sessions[session_id] = {
-            'session': requests.Session(),
+        self.backend.save({
+            'session_id': session_id,
+            'session': upstream_session or new_upstream_session(),
             'email_hash': hashlib.sha256(email.encode()).hexdigest(),
             'created_at': datetime.now(),
             'last_accessed': datetime.now()
-        }
+        })
         logger.info(f"Session created: {session_id[:8]}...")
         return session_id
     
     def get_session(self, session_id: str):
         """セッションを取得（タイムアウトチェック付き）"""
-        if session_id not in self.sessions:
+        session_data = self.get_session_data(session_id)
+        return session_data['session'] if session_data else None
+    
+    def get_session_data(self, session_id: str):
+        """セッション情報（email_hash等を含む）を取得"""
+        session_data = self.backend.get(session_id)
+        if session_data is None:
             return None
         
-        session_data = self.sessions[session_id]
-        
         # タイムアウトチェック
         if datetime.now() - session_data['last_accessed'] > self.session_timeout:
             logger.warning(f"Session timeout: {session_id[:8]}...")
@@ -112,27 +931,705 @@ class SecureSessionManager:
         
         # アクセス時刻を更新
         session_data['last_accessed'] = datetime.now()
-        return session_data['session']
+        self.backend.touch(session_data)
+        return session_data
+    
+    def save_cookies(self, session_data: dict):
+        """上流の応答で更新されたCookieを保存（他のワーカー・再起動後も同じ上流セッションを使う）"""
+        self.backend.save_cookies(session_data)
     
     def delete_session(self, session_id: str):
         """セッションを削除"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        if self.backend.delete(session_id):
             logger.info(f"Session deleted: {session_id[:8]}...")
     
+    def stats(self) -> dict:
+        """セッション数・メモリのゲージ"""
+        return self.backend.stats()
+    
     def cleanup_expired_sessions(self):
         """期限切れセッションをクリーンアップ"""
-        now = datetime.now()
-        expired = [
-            sid for sid, data in self.sessions.items()
-            if now - data['last_accessed'] > self.session_timeout
-        ]
+        expired = self.backend.expired_ids(datetime.now() - self.session_timeout)
         for sid in expired:
             self.delete_session(sid)
         if expired:
             logger.info(f"Cleaned up {len(expired)} expired sessions")
 
-session_manager = SecureSessionManager()
+session_manager = SecureSessionManager(
+    SQLiteSessionBackend(SESSION_DB_PATH) if SESSION_BACKEND == 'sqlite' else MemorySessionBackend()
+)
+
+# ⚡ チップ履歴キャッシュ設定
+CHIP_CACHE_MAX_BYTES = int(os.environ.get('CHIP_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CURRENT_MONTH_CACHE_TTL = int(os.environ.get('CURRENT_MONTH_CACHE_TTL', '300'))  # 秒
+
+def current_month() -> str:
+    """現在の月 (YYYY-MM)"""
+    return datetime.now().strftime('%Y-%m')
+
+def estimate_rows_size(rows) -> int:
+    """パース済み行リストのおおよそのメモリ使用量（バイト）"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row.values():
+            size += sys.getsizeof(value)
+    return size
+
+# ⚡ 月単位のチップ履歴キャッシュ
+class ChipHistoryCache:
+    """(email_hash, store_id, month) をキーに parse_chip_history の結果を保持
+
+    終了した月は変化しないため容量上限（LRU）に達するまで保持し、
+    当月のみ短いTTLで再取得する。店舗一覧・集計用の列データも同じ容量上限で保持する。
+    """
+    def __init__(self, max_bytes: int, current_month_ttl: int):
+        self.max_bytes = max_bytes
+        self.current_month_ttl = current_month_ttl
+        self.entries = OrderedDict()  # key -> (rows, size, expires_at)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        """キャッシュ済みの行を取得（期限切れ・未登録はNone）"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                rows, size, expires_at = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return rows
+                self._remove(key)
+            self.misses += 1
+            return None
+    
+    def put(self, key, rows, size: int = None):
+        """行を登録（当月はTTL付き、過去月は無期限）。size を省略すると行から見積もる"""
+        month = key[2]
+        if month >= current_month():
+            if self.current_month_ttl <= 0:
+                return
+            expires_at = time.monotonic() + self.current_month_ttl
+        else:
+            expires_at = None
+        
+        if size is None:
+            size = estimate_rows_size(rows)
+        if size > self.max_bytes:
+            return
+        
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (rows, size, expires_at)
+            self.total_bytes += size
+            # 🔒 容量超過時は最も古いエントリから追い出す
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+    
+    def stats(self) -> dict:
+        """ヒット率などの統計情報"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+chip_cache = ChipHistoryCache(CHIP_CACHE_MAX_BYTES, CURRENT_MONTH_CACHE_TTL)
+
+# ⚡ 永続チップ履歴ストア設定（空文字で無効化）
+CHIP_STORE_PATH = os.environ.get(
+    'CHIP_STORE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chip_histories.db')
+)
+
+# ⚡ ユーザー別チップ履歴の永続ストア
+class ChipHistoryStore:
+    """(email_hash, store_id, month) 単位でパース済みの行をSQLiteに保存
+
+    終了後に取得した月は complete として扱い、再ログイン・再起動後も
+    上流へアクセスせずに返す。当月は毎回再同期する。
+    永続化はベストエフォートで、DBが使えない場合はキャッシュミスとして扱う。
+    """
+    def __init__(self, path: str):
+        self.db = SQLiteDatabase(path, '''
+            CREATE TABLE IF NOT EXISTS month_rows (
+                email_hash TEXT NOT NULL,
+                store_id TEXT NOT NULL,
+                month TEXT NOT NULL,
+                rows TEXT NOT NULL,
+                complete INTEGER NOT NULL,
+                synced_at REAL NOT NULL,
+                PRIMARY KEY (email_hash, store_id, month)
+            );
+        ''', private=True)
+    
+    def get_month(self, email_hash: str, store_id: str, month: str):
+        """同期済み（確定済み）の月の行を取得（未同期・DBエラーはNone）"""
+        try:
+            rows = self.db.execute(
+                'SELECT rows FROM month_rows '
+                'WHERE email_hash = ? AND store_id = ? AND month = ? AND complete = 1',
+                (email_hash, store_id, month)
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Chip history store read failed: {sanitize_error_message(e)}")
+            return None
+        return json.loads(rows[0][0]) if rows else None
+    
+    def put_month(self, email_hash: str, store_id: str, month: str, rows):
+        """月の行を保存（終了済みの月は確定として記録）"""
+        complete = 1 if month < current_month() else 0
+        payload = json.dumps(rows, ensure_ascii=False, separators=(',', ':'))
+        try:
+            self.db.execute(
+                'INSERT OR REPLACE INTO month_rows '
+                '(email_hash, store_id, month, rows, complete, synced_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (email_hash, store_id, month, payload, complete, time.time())
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Chip history store write failed: {sanitize_error_message(e)}")
+    
+    def stats(self) -> dict:
+        """保存件数などの統計情報"""
+        try:
+            months, users = self.db.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT email_hash) FROM month_rows'
+            )[0]
+        except sqlite3.Error as e:
+            return {'error': type(e).__name__}
+        return {'months': months, 'users': users}
+
+chip_store = ChipHistoryStore(CHIP_STORE_PATH) if CHIP_STORE_PATH else None
+
+# 🔒 上流サイトへの同時リクエスト数の上限（全ユーザー合計）
+# ⚡ 同時実行数は上流の応答に応じて MIN〜MAX の範囲で自動調整（AIMD）
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', '16'))
+UPSTREAM_MIN_CONCURRENCY = int(os.environ.get('UPSTREAM_MIN_CONCURRENCY', '2'))
+UPSTREAM_INITIAL_CONCURRENCY = int(os.environ.get('UPSTREAM_INITIAL_CONCURRENCY', '10'))
+# これより遅い応答では同時実行数を増やさない（秒）
+UPSTREAM_LATENCY_TARGET = float(os.environ.get('UPSTREAM_LATENCY_TARGET', '2.0'))
+# 🔁 一時的なエラー（429/5xx/タイムアウト/接続エラー）の再試行
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BASE_DELAY = float(os.environ.get('UPSTREAM_RETRY_BASE_DELAY', '0.5'))
+UPSTREAM_RETRY_MAX_DELAY = 4.0
+# 遅い月の取得に同じリクエストを追加で送り、先に返った方を使う（ヘッジ）
+UPSTREAM_HEDGE = os.environ.get('UPSTREAM_HEDGE', 'false').lower() == 'true'
+UPSTREAM_HEDGE_MIN_DELAY = 1.0  # ヘッジまでの最短待ち時間（秒）
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+# ⏱️ バッチ取得の締め切り（秒）。過ぎたら取得済みの月だけ返し、残りは missing_months で通知
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', '15'))
+BATCH_MIN_DEADLINE = 1.0  # deadline_ms で指定できる最短
+# 📤 エクスポートで先行して取得する月数・1回に出力できる最大月数
+EXPORT_PREFETCH_MONTHS = int(os.environ.get('EXPORT_PREFETCH_MONTHS', '4'))
+EXPORT_MAX_MONTHS = 120
+# 🔥 ログイン直後に店舗一覧と既定店舗の直近の月を低優先度で先読みする
+PREFETCH_ON_LOGIN = os.environ.get('PREFETCH_ON_LOGIN', 'false').lower() == 'true'
+PREFETCH_MONTHS = int(os.environ.get('PREFETCH_MONTHS', '3'))  # 当月から遡る月数
+# 上流I/Oエンジン: 'threads'（requests）または 'async'（asyncio + aiohttp）
+UPSTREAM_ENGINE = os.environ.get('UPSTREAM_ENGINE', 'threads')
+
+# ⚡ aiohttp は非同期エンジンを使う場合だけ読み込む（起動時間短縮）
+aiohttp = None
+if UPSTREAM_ENGINE == 'async':
+    try:
+        import aiohttp
+    except ImportError:
+        logger.warning("aiohttp is not installed; falling back to threaded upstream engine")
+# ⚡ 上流への keep-alive 接続数の上限（全ユーザーで共有、同時実行数より余裕を持たせる）
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', str(max(32, UPSTREAM_MAX_CONCURRENCY * 2))))
+# 上限に達したら新規接続を作らずに空きを待つ（ソケット数を常に上限以内に保つ）
+UPSTREAM_POOL_BLOCK = os.environ.get('UPSTREAM_POOL_BLOCK', 'true').lower() == 'true'
+
+# ⚡ 全セッションで共有するコネクションプール
+shared_upstream_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+    pool_block=UPSTREAM_POOL_BLOCK
+)
+
+class UpstreamSession(requests.Session):
+    """共有コネクションプールを使う requests.Session
+
+    ユーザーごとに保持するのは CookieJar（認証状態）だけで、
+    TLS接続は全セッションで再利用する。
+    """
+    def __init__(self):
+        super().__init__()
+        self.adapters.clear()
+        self.mount('https://', shared_upstream_adapter)
+        self.mount('http://', shared_upstream_adapter)
+    
+    def request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        except requests.Timeout:
+            status = 'timeout'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            record_upstream_call(url, status, elapsed)
+            record_span('upstream', started, method=method, path=urlsplit(url).path, status=status)
+            upstream_scheduler.record_result(status, elapsed)
+    
+    def close(self):
+        # 共有プールは閉じない（Cookieだけ破棄）
+        self.cookies.clear()
+
+def new_upstream_session() -> requests.Session:
+    """ログインごとの上流セッションを生成（接続は共有プール）"""
+    return UpstreamSession()
+
+# requests.Response と同じ属性名で扱える上流レスポンス
+UpstreamResponse = namedtuple('UpstreamResponse', ['status_code', 'url', 'text'])
+
+# ⚡ asyncio ベースの上流クライアント
+class AsyncUpstreamClient:
+    """専用スレッドのイベントループ上で aiohttp により上流へアクセス
+
+    接続はプロセス全体で共有し、Cookie はセッションごとの
+    requests の CookieJar から付与・更新するためユーザー間で混ざらない。
+    OSスレッドを増やさずに多数のリクエストを同時に待機できる。
+    """
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self.client = None
+        self.loop = None
+        self.pid = None
+        self.lock = threading.Lock()
+    
+    def _get_loop(self):
+        # イベントループのスレッドは fork 後の最初の利用時にワーカーごとに開始する
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                self.client = None
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='upstream-loop', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+            return self.loop
+    
+    def run(self, coro) -> Future:
+        """コルーチンをイベントループで実行し concurrent.futures.Future を返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+    
+    def _get_client(self):
+        # aiohttp.ClientSession はイベントループ上で生成する必要がある
+        if self.client is None:
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections),
+                cookie_jar=aiohttp.DummyCookieJar()
+            )
+        return self.client
+    
+    async def get(self, session, url: str, timeout: float = 10) -> UpstreamResponse:
+        """session（requests.Session）のCookieを使ってGET"""
+        headers = {}
+        cookie_header = requests.cookies.get_cookie_header(session.cookies, requests.Request('GET', url))
+        if cookie_header:
+            headers['Cookie'] = cookie_header
+        
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async with self._get_client().get(
+                url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                text = await response.text()
+                # リダイレクト途中を含めて Set-Cookie をユーザーのCookieJarへ反映
+                for hop in (*response.history, response):
+                    for name, morsel in hop.cookies.items():
+                        session.cookies.set(
+                            name, morsel.value,
+                            domain=morsel['domain'] or hop.url.host,
+                            path=morsel['path'] or '/'
+                        )
+                status = str(response.status)
+                return UpstreamResponse(response.status, str(response.url), text)
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            raise requests.Timeout(f"Upstream timeout: {url}")
+        except asyncio.CancelledError:
+            status = 'cancelled'  # 締め切り等でこちらから中断（上流の負荷としては扱わない）
+            raise
+        except aiohttp.ClientError as e:
+            raise TransientUpstreamError(f"Upstream connection error: {type(e).__name__}")
+        finally:
+            elapsed = time.perf_counter() - started
+            record_upstream_call(url, status, elapsed)
+            record_span('upstream', started, method='GET', path=urlsplit(url).path, status=status)
+            upstream_scheduler.record_result(status, elapsed)
+
+async_upstream = AsyncUpstreamClient(UPSTREAM_POOL_MAXSIZE) if aiohttp is not None else None
+
+async def run_in_span(parent_span, wait, coro):
+    """投入元のトレースを引き継いでコルーチンを実行（タスクごとにコンテキストは独立）"""
+    current_span.set(parent_span)
+    with trace_span('scheduler_task', queue_wait_ms=round(wait * 1000, 3)):
+        return await coro
+
+# 🔒 上流リクエストの共有スケジューラ
+class UpstreamScheduler:
+    """全ユーザーの上流リクエストを共通の同時実行上限で実行
+
+    セッションごとにキューを持ち、ラウンドロビンで1件ずつ取り出すため、
+    24ヶ月分のバッチが他ユーザーの単月リクエストを待たせ続けることはない。
+    コルーチン関数のタスクはスレッドを使わず非同期エンジン上で実行する。
+    
+    同時実行数の上限（limit）は AIMD で調整する: 速い応答が limit 件続くと +1、
+    429/5xx/タイムアウトで半分（連続した失敗で下げすぎないよう1秒に1回まで）。
+    
+    先読みなどのバックグラウンドタスクは別キューに入れ、通常のタスクが待っていない時だけ、
+    limit の 1/BACKGROUND_SHARE までの同時実行数で動かす（通常のタスク用の枠を常に残す）。
+    """
+    DECREASE_COOLDOWN = 1.0  # 秒
+    BACKGROUND_SHARE = 4
+    
+    def __init__(self, max_concurrency: int, async_client=None, min_concurrency: int = 1,
+                 initial_concurrency: int = None, latency_target: float = UPSTREAM_LATENCY_TARGET):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = min(max(initial_concurrency or max_concurrency, self.min_concurrency), max_concurrency)
+        self.latency_target = latency_target
+        self.successes = 0
+        self.increases = 0
+        self.decreases = 0
+        self.last_decrease = 0.0
+        self.latencies = deque(maxlen=200)  # 直近の成功応答の所要時間
+        self.async_client = async_client
+        self.queues = OrderedDict()  # owner -> deque[(future, fn, args, kwargs, enqueued_at, parent_span)]
+        self.queued = 0
+        self.background_queues = OrderedDict()  # owner -> deque（低優先度）
+        self.background_queued = 0
+        self.active = 0
+        self.background_active = 0
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.async_tasks = {}  # 実行中の非同期タスク（Future -> run_coroutine_threadsafe の Future）
+        self.started_async = []  # ロック解放後に完了通知を登録する (Future, タスク, background)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix='upstream'
+        )
+    
+    def submit(self, owner: str, fn, *args, background=False, **kwargs) -> Future:
+        """タスクを owner のキューに追加し Future を返す（background=True なら低優先度）"""
+        future = Future()
+        queues = self.background_queues if background else self.queues
+        with self._dispatching():
+            queue = queues.get(owner)
+            if queue is None:
+                queue = queues[owner] = deque()
+            queue.append((future, fn, args, kwargs, time.monotonic(), current_span.get()))
+            if background:
+                self.background_queued += 1
+            else:
+                self.queued += 1
+            self._dispatch()
+        return future
+    
+    def promote(self, owner: str):
+        """owner の実行待ちのバックグラウンドタスクを通常の優先度に移す"""
+        with self._dispatching():
+            queue = self.background_queues.pop(owner, None)
+            if queue is None:
+                return
+            self.queues.setdefault(owner, deque()).extend(queue)
+            self.background_queued -= len(queue)
+            self.queued += len(queue)
+            self._dispatch()
+    
+    def call(self, owner: str, fn, *args, **kwargs):
+        """タスクを投入して結果を待つ"""
+        return self.submit(owner, fn, *args, **kwargs).result()
+    
+    @contextmanager
+    def _dispatching(self):
+        """ロックを取得し、解放後に _dispatch で開始した非同期タスクの完了通知を登録する
+
+        完了済みの Future に add_done_callback するとその場でコールバックが呼ばれるため、
+        ロック保持中に登録すると _finish_async がロックを再取得してデッドロックする。
+        """
+        started = []
+        try:
+            with self.lock:
+                try:
+                    yield
+                finally:
+                    started, self.started_async = self.started_async, []
+        finally:
+            for future, task, background in started:
+                task.add_done_callback(
+                    lambda task, future=future, background=background: self._finish_async(future, task, background)
+                )
+    
+    def _dispatch(self):
+        """空きスロットがあればラウンドロビンで次のタスクを開始（_dispatching の中で呼ぶ）"""
+        while self.active < self.limit:
+            if self.queues:
+                queues, background = self.queues, False
+            elif self.background_queues and self.background_active < max(1, self.limit // self.BACKGROUND_SHARE):
+                queues, background = self.background_queues, True
+            else:
+                break
+            owner, queue = next(iter(queues.items()))
+            future, fn, args, kwargs, enqueued_at, parent_span = queue.popleft()
+            if queue:
+                queues.move_to_end(owner)
+            else:
+                del queues[owner]
+            if background:
+                self.background_queued -= 1
+            else:
+                self.queued -= 1
+            
+            # キャンセル済みのタスクはスロットを消費しない
+            if not future.set_running_or_notify_cancel():
+                continue
+            
+            wait = time.monotonic() - enqueued_at
+            self.dispatched += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            upstream_queue_wait.observe(wait)
+            self.active += 1
+            self.background_active += background
+            if self.async_client and asyncio.iscoroutinefunction(fn):
+                task = self.async_client.run(run_in_span(parent_span, wait, fn(*args, **kwargs)))
+                self.async_tasks[future] = task
+                self.started_async.append((future, task, background))
+            else:
+                self.executor.submit(self._run, future, fn, args, kwargs, parent_span, wait, background)
+    
+    def _run(self, future, fn, args, kwargs, parent_span=None, wait=0.0, background=False):
+        # 投入元のトレースを引き継ぐ（ワーカースレッドは使い回すので終了時に戻す）
+        token = current_span.set(parent_span)
+        try:
+            with trace_span('scheduler_task', queue_wait_ms=round(wait * 1000, 3)):
+                result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            current_span.reset(token)
+            self._release(background)
+    
+    def _finish_async(self, future, task, background=False):
+        with self.lock:
+            self.async_tasks.pop(future, None)
+        try:
+            future.set_result(task.result())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._release(background)
+    
+    def _release(self, background=False):
+        with self._dispatching():
+            self.active -= 1
+            self.background_active -= background
+            self._dispatch()
+    
+    def abort(self, future) -> bool:
+        """実行待ちならキャンセル、非同期エンジンで実行中なら通信を中断してスロットを空ける
+
+        スレッドで実行中のリクエストは中断できないため、タイムアウトまでに終わるのを待つ。
+        """
+        if future.cancel():
+            return True
+        with self.lock:
+            task = self.async_tasks.get(future)
+        return task.cancel() if task is not None else False
+    
+    def record_result(self, status: str, seconds: float):
+        """上流の応答結果で同時実行数の上限を調整"""
+        overloaded = status in ('timeout', 'error', '429') or status.startswith('5')
+        with self._dispatching():
+            if overloaded:
+                self.successes = 0
+                now = time.monotonic()
+                if now - self.last_decrease >= self.DECREASE_COOLDOWN and self.limit > self.min_concurrency:
+                    self.limit = max(self.min_concurrency, self.limit // 2)
+                    self.last_decrease = now
+                    self.decreases += 1
+                    logger.info(f"Upstream concurrency decreased to {self.limit} ({status})")
+                return
+            if not status.startswith(('2', '3')):
+                return
+            self.latencies.append(seconds)
+            # 上限いっぱいまで使われていて、かつ速い場合だけ増やす
+            if seconds > self.latency_target or not (self.queued or self.active >= self.limit):
+                return
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self.successes = 0
+                self.increases += 1
+                self._dispatch()
+    
+    def latency_percentile(self, q: float):
+        """直近の成功応答の所要時間のパーセンタイル（件数が少なければNone）"""
+        latencies = sorted(self.latencies)
+        if len(latencies) < 20:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+    
+    def has_spare_capacity(self) -> bool:
+        """待ち行列が無く、上限まで余裕があるか"""
+        with self.lock:
+            return not self.queued and self.active < self.limit
+    
+    def stats(self) -> dict:
+        """キュー長・待ち時間などの統計情報"""
+        p95 = self.latency_percentile(0.95)
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'min_concurrency': self.min_concurrency,
+                'max_concurrency': self.max_concurrency,
+                'limit_increases': self.increases,
+                'limit_decreases': self.decreases,
+                'p95_latency_ms': round(p95 * 1000, 2) if p95 is not None else None,
+                'active': self.active,
+                'queue_depth': self.queued,
+                'queued_sessions': len(self.queues),
+                'background_active': self.background_active,
+                'background_queue_depth': self.background_queued,
+                'dispatched': self.dispatched,
+                'avg_wait_ms': round(self.total_wait / self.dispatched * 1000, 2) if self.dispatched else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+            }
+
+upstream_scheduler = UpstreamScheduler(
+    UPSTREAM_MAX_CONCURRENCY, async_upstream,
+    min_concurrency=UPSTREAM_MIN_CONCURRENCY,
+    initial_concurrency=UPSTREAM_INITIAL_CONCURRENCY
+)
+
+# ⏲️ 遅延実行（再試行の待機・ヘッジの起動）
+class DelayedCalls:
+    """1本のスレッドで関数を指定秒数後に実行（スレッドは最初の利用時に開始）"""
+    def __init__(self):
+        self.heap = []  # (実行時刻, 連番, 関数)
+        self.sequence = count()
+        self.condition = threading.Condition()
+        self.pid = None
+    
+    def call_later(self, delay: float, fn):
+        with self.condition:
+            if self.pid != os.getpid():
+                self.heap.clear()
+                threading.Thread(target=self._run, name='delayed-calls', daemon=True).start()
+                self.pid = os.getpid()
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.sequence), fn))
+            self.condition.notify()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, fn = heapq.heappop(self.heap)
+            try:
+                fn()
+            except Exception as e:
+                logger.warning(f"Delayed call failed: {sanitize_error_message(e)}")
+
+delayed_calls = DelayedCalls()
+
+# ⚡ 実行中の同一リクエストの集約（single-flight）
+class SingleFlight:
+    """同じキーの上流リクエストが実行中なら、新たに送らずその結果を待つ
+
+    呼び出し元ごとに別の Future を返すため、ある呼び出し元のキャンセルが
+    他の待機者に影響しない（全員がキャンセルした場合のみ本体を取り消す）。
+    """
+    def __init__(self):
+        self.calls = {}  # key -> (shared_future, [waiter_future, ...])
+        self.coalesced = 0
+        self.lock = threading.Lock()
+    
+    def submit(self, key, start) -> Future:
+        """key が実行中でなければ start() で開始し、結果を待つ Future を返す"""
+        waiter = Future()
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = (start(), [])
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+            call[1].append(waiter)
+        
+        shared = call[0]
+        if leader:
+            shared.add_done_callback(lambda shared: self._complete(key, shared))
+        waiter.add_done_callback(lambda waiter: self._on_waiter_done(key, shared, waiter))
+        return waiter
+    
+    def _complete(self, key, shared):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None or call[0] is not shared:
+                return
+            del self.calls[key]
+            waiters = call[1]
+        
+        for waiter in waiters:
+            if not waiter.set_running_or_notify_cancel():
+                continue
+            if shared.cancelled():
+                waiter.set_exception(UpstreamError("Upstream request cancelled"))
+            elif shared.exception() is not None:
+                waiter.set_exception(shared.exception())
+            else:
+                waiter.set_result(shared.result())
+    
+    def _on_waiter_done(self, key, shared, waiter):
+        if not waiter.cancelled():
+            return
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None or call[0] is not shared:
+                return
+            if waiter in call[1]:
+                call[1].remove(waiter)
+            if call[1]:
+                return
+            del self.calls[key]
+        # 待機者がいなくなった未着手のリクエストは取り消す
+        shared.cancel()
+    
+    def stats(self) -> dict:
+        """集約件数などの統計情報"""
+        with self.lock:
+            return {'in_flight': len(self.calls), 'coalesced': self.coalesced}
+
+month_fetch_flight = SingleFlight()
 
 # 🔒 入力検証関数
 def validate_email(email: str) -> bool:
@@ -149,6 +1646,18 @@ def validate_store_id(store_id: str) -> bool:
     """店舗IDの検証（数値のみ）"""
     return store_id.isdigit() and 1 <= int(store_id) <= 100
 
+class UpstreamError(Exception):
+    """上流サイトから正常な応答が得られなかった"""
+    pass
+
+class TransientUpstreamError(UpstreamError):
+    """再試行すれば成功する可能性がある上流エラー（429/5xx/接続エラー）"""
+    pass
+
+def is_transient_error(error: BaseException) -> bool:
+    """再試行の対象となるエラーか"""
+    return isinstance(error, (TransientUpstreamError, requests.Timeout, requests.ConnectionError))
+
 def sanitize_error_message(error: Exception) -> str:
     """エラーメッセージをサニタイズ（内部情報を隠す）"""
     error_str = str(error)
@@ -157,12 +1666,303 @@ def sanitize_error_message(error: Exception) -> str:
         return "Internal server error"
     return "An error occurred"
 
+# ⚡ 応答のエンコード（列指向JSON / MessagePack / 圧縮）
+ROW_FIELDS = ('date', 'ring_chips', 'tournament_chips', 'purchase',
+              'total_change', 'current_balance', 'store_name')
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESS_MIN_BYTES = 1024  # これより小さい応答は圧縮しない
+
+def to_columnar(rows) -> dict:
+    """行のリストを列ごとの配列に変換（キー名の繰り返しを無くす）"""
+    return {field: [row.get(field) for row in rows] for field in ROW_FIELDS}
+
+def dumps_json(payload) -> bytes:
+    """高速なJSONシリアライザ（orjson）があれば使用"""
+    if orjson:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def preferred_mimetype(candidates, default: str = 'application/json') -> str:
+    """Acceptのq値で default 以上に求められている候補を返す（無ければ default）
+
+    候補は Accept に明示されたものだけを対象にし（*/* では選ばない）、q=0は拒否扱い。
+    """
+    accept = request.accept_mimetypes
+    explicit = {value.lower(): quality for value, quality in accept}
+    best, best_quality = default, accept.quality(default) if accept.provided else 1
+    for mimetype in candidates:
+        quality = explicit.get(mimetype, 0)
+        if quality > 0 and quality >= best_quality:
+            best, best_quality = mimetype, quality
+    return best
+
+def encode_body(payload):
+    """Acceptヘッダーに応じて (本文, mimetype) を返す"""
+    started = time.perf_counter()
+    if msgpack and preferred_mimetype(MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES:
+        body, mimetype = msgpack.packb(payload, use_bin_type=True), 'application/msgpack'
+    else:
+        body, mimetype = dumps_json(payload), 'application/json'
+    encode_latency.observe(time.perf_counter() - started, mimetype)
+    record_span('serialize', started, format=mimetype, bytes=len(body))
+    return body, mimetype
+
+def preferred_encoding(available):
+    """Accept-Encodingのq値が最も高い方式を返す（q=0は拒否扱い、同値なら available の順）"""
+    accept_encodings = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def choose_encoding(body: bytes):
+    """Accept-Encodingと本文サイズから圧縮方式を選ぶ（圧縮しない場合はNone）"""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return None
+    return preferred_encoding(('br', 'gzip') if brotli else ('gzip',))
+
+def compress_body(body: bytes, encoding):
+    """選んだ方式で本文を圧縮"""
+    started = time.perf_counter()
+    if encoding == 'br':
+        body = brotli.compress(body, quality=5)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+    else:
+        return body
+    record_span('compress', started, encoding=encoding, bytes=len(body))
+    return body
+
+def rows_response(payload: dict, status: int = 200, conditional: bool = False) -> Response:
+    """チップ履歴の応答を生成（?format=columnar で列指向、Accept/Accept-Encodingで形式と圧縮を選択）"""
+    if request.args.get('format') == 'columnar':
+        payload = dict(payload, format='columnar')
+        if 'data' in payload:
+            payload['data'] = to_columnar(payload['data'])
+        if 'by_store' in payload:
+            payload['by_store'] = {
+                store_id: to_columnar(rows) for store_id, rows in payload['by_store'].items()
+            }
+    
+    return encoded_response(payload, status, conditional)
+
+def encoded_response(payload: dict, status: int = 200, conditional: bool = False) -> Response:
+    """エンコード・圧縮した応答を生成（conditional=True でETag / 304に対応）"""
+    body, mimetype = encode_body(payload)
+    encoding = choose_encoding(body)
+    
+    # ⚡ 内容が変わっていなければ本文を返さない（圧縮もしない）
+    etag = None
+    if conditional:
+        # 圧縮方式が違えば別の表現なので末尾で区別する
+        etag = content_etag(body) + (f'-{encoding}' if encoding else '')
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Vary'] = 'Accept, Accept-Encoding'
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+    
+    response = Response(compress_body(body, encoding), status=status, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def content_etag(body: bytes) -> str:
+    """エンコード済み本文の内容ハッシュ（ETag値）"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+# 📦 静的ファイルキャッシュ（起動時にビルドディレクトリを一度だけ走査）
+STATIC_CACHE_DIR = os.environ.get(
+    'STATIC_CACHE_DIR', os.path.join(tempfile.gettempdir(), f'junpo-static-{os.getuid()}')
+)  # 圧縮版の保存先（空文字でメモリのみ。所有者のみアクセスできるディレクトリに限る）
+STATIC_SENDFILE_MIN_BYTES = 256 * 1024  # これ以上のファイルはメモリに載せず sendfile で送る
+STATIC_BROTLI_QUALITY = int(os.environ.get('STATIC_BROTLI_QUALITY', '9'))
+STATIC_COMPRESSIBLE_EXTENSIONS = {
+    '', '.html', '.js', '.mjs', '.css', '.json', '.map', '.symbols',
+    '.wasm', '.svg', '.txt', '.otf', '.ttf',
+}
+HASHED_FILENAME_PATTERN = re.compile(r'[.-][0-9a-f]{8,}\.\w+$')
+
+mimetypes.add_type('application/wasm', '.wasm')
+
+# 配信する本体（body があればメモリから、無ければ path から sendfile）
+StaticVariant = namedtuple('StaticVariant', ['path', 'size', 'body', 'etag'])
+
+class StaticAsset:
+    """1ファイル分の配信情報（圧縮方式ごとの本体を持つ）"""
+    __slots__ = ('path', 'digest', 'mimetype', 'cache_control', 'compressible', 'variants')
+    
+    def __init__(self, path, digest, mimetype, cache_control, compressible, variants):
+        self.path = path
+        self.digest = digest
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.compressible = compressible
+        self.variants = variants  # {None: 無圧縮, 'br': ..., 'gzip': ...}
+
+def precompress_bytes(data: bytes, encoding: str) -> bytes:
+    """静的ファイル用の圧縮（一度だけなので高めの圧縮率）"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=STATIC_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9)
+
+class StaticAssetCache:
+    """Flutter web ビルドのファイル一覧・ETag・圧縮版を保持
+
+    一覧は create_app() で作成する。ビルドを更新した場合は再起動が必要。
+    """
+    def __init__(self, root: str, cache_dir: str = ''):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.assets = {}
+    
+    def index(self):
+        """ビルドディレクトリを走査してETagを計算"""
+        assets = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                full_path = os.path.join(dirpath, name)
+                # ビルド時に生成済みの圧縮版は元ファイルの variant として扱う
+                if name.endswith(('.br', '.gz')) and os.path.exists(full_path[:-3]):
+                    continue
+                rel_path = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                assets[rel_path] = self._load(full_path, name)
+        self.assets = assets
+        logger.info(f"Indexed {len(assets)} static files in {self.root}")
+    
+    def _variant(self, path: str, etag: str, data: bytes = None) -> StaticVariant:
+        size = len(data) if data is not None else os.path.getsize(path)
+        if data is None and size < STATIC_SENDFILE_MIN_BYTES:
+            with open(path, 'rb') as f:
+                data = f.read()
+        # 保存先のないメモリ上の圧縮版は大きくても本体を保持する
+        body = data if size < STATIC_SENDFILE_MIN_BYTES or path is None else None
+        return StaticVariant(path, size, body, etag)
+    
+    def _load(self, full_path: str, name: str) -> StaticAsset:
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        variants = {None: self._variant(full_path, digest, data)}
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if os.path.exists(full_path + suffix) and (encoding != 'br' or brotli):
+                variants[encoding] = self._variant(full_path + suffix, f'{digest}-{encoding}')
+        
+        # ファイル名にハッシュを含むものは内容が変わらないので長期キャッシュ
+        if HASHED_FILENAME_PATTERN.search(name):
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'no-cache'
+        return StaticAsset(
+            full_path, digest,
+            mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            cache_control,
+            os.path.splitext(name)[1] in STATIC_COMPRESSIBLE_EXTENSIONS,
+            variants
+        )
+    
+    def get(self, path: str):
+        return self.assets.get(path)
+    
+    def precompress(self):
+        """圧縮版を生成（STATIC_CACHE_DIR に保存し、再起動時は再利用）"""
+        if self.cache_dir and not self._prepare_cache_dir():
+            logger.error(f"Static cache dir is not private, keeping compressed files in memory: {self.cache_dir}")
+            self.cache_dir = ''
+        encodings = ('br', 'gzip') if brotli else ('gzip',)
+        started = time.time()
+        for asset in list(self.assets.values()):
+            identity = asset.variants[None]
+            if not asset.compressible or identity.size < COMPRESS_MIN_BYTES:
+                continue
+            for encoding in encodings:
+                if encoding in asset.variants:
+                    continue
+                variant = self._compressed_variant(asset, encoding)
+                # 圧縮しても小さくならないものは無圧縮のまま配信
+                if variant.size < identity.size:
+                    asset.variants[encoding] = variant
+        logger.info(f"Static assets precompressed in {time.time() - started:.1f}s")
+    
+    def _prepare_cache_dir(self) -> bool:
+        """保存先を 0700 で作成し、自分だけが書き込めるディレクトリか確認する
+
+        🔒 他のユーザーが置いた圧縮版をそのまま配信しないよう、
+        シンボリックリンク・他人の所有・グループや他人の権限があるものは使わない。
+        """
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            info = os.lstat(self.cache_dir)
+        except OSError:
+            return False
+        return (
+            stat.S_ISDIR(info.st_mode)
+            and info.st_uid == os.getuid()
+            and stat.S_IMODE(info.st_mode) & 0o077 == 0
+        )
+    
+    def _compressed_variant(self, asset: StaticAsset, encoding: str) -> StaticVariant:
+        etag = f'{asset.digest}-{encoding}'
+        if not self.cache_dir:
+            with open(asset.path, 'rb') as f:
+                return self._variant(None, etag, precompress_bytes(f.read(), encoding))
+        
+        path = os.path.join(self.cache_dir, f"{asset.digest}.{'br' if encoding == 'br' else 'gz'}")
+        if not os.path.exists(path):
+            with open(asset.path, 'rb') as f:
+                data = precompress_bytes(f.read(), encoding)
+            # 複数ワーカーが同時に書いても壊れないように一時ファイルから置き換える
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return self._variant(path, etag)
+    
+    def start_precompress(self):
+        """圧縮版の生成をバックグラウンドで開始（完了までは無圧縮で配信）"""
+        thread = threading.Thread(target=self.precompress, daemon=True)
+        thread.start()
+        return thread
+
+static_assets = StaticAssetCache(WEB_DIR, STATIC_CACHE_DIR)
+
+def static_response(asset: StaticAsset) -> Response:
+    """事前圧縮済みの本体を選んで返す（If-None-Match一致なら304）"""
+    encoding = preferred_encoding([e for e in ('br', 'gzip') if e in asset.variants])
+    variant = asset.variants[encoding]
+    
+    if request.if_none_match.contains(variant.etag):
+        response = Response(status=304)
+    elif variant.body is not None:
+        response = Response(variant.body, mimetype=asset.mimetype)
+    else:
+        # ⚡ 大きいファイルは wsgi.file_wrapper 経由で送る（対応サーバーでは sendfile）
+        response = send_file(variant.path, mimetype=asset.mimetype, conditional=False, etag=False)
+    
+    response.set_etag(variant.etag)
+    response.headers['Cache-Control'] = asset.cache_control
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if asset.compressible:
+        response.vary.add('Accept-Encoding')
+    return response
+
 # Serve Flutter web app
-@app.route('/')
+@routes.route('/')
 def serve_index():
-    return send_from_directory(WEB_DIR, 'index.html')
+    asset = static_assets.get('index.html')
+    if asset is None:
+        return send_from_directory(WEB_DIR, 'index.html')
+    return static_response(asset)
 
-@app.route('/<path:path>')
+@routes.route('/<path:path>')
 def serve_static(path):
     # Check if it's an API request
     if path.startswith('proxy/'):
@@ -173,15 +1973,14 @@ def serve_static(path):
     if '..' in safe_path or safe_path.startswith('/'):
         return jsonify({'error': 'Invalid path'}), 400
     
-    # Serve static files
-    full_path = os.path.join(WEB_DIR, safe_path)
-    if os.path.exists(full_path) and os.path.commonpath([WEB_DIR, full_path]) == WEB_DIR:
-        return send_from_directory(WEB_DIR, safe_path)
-    else:
+    # Serve static files（起動時の一覧に無いパスはアプリのルーティングに任せる）
+    asset = static_assets.get(safe_path) or static_assets.get('index.html')
+    if asset is None:
         return send_from_directory(WEB_DIR, 'index.html')
+    return static_response(asset)
 
 # 🔒 API Routes with Security
-@app.route('/proxy/api/login', methods=['POST', 'OPTIONS'])
+@routes.route('/proxy/api/login', methods=['POST', 'OPTIONS'])
 @limiter.limit("10 per minute")  # ログイン試行回数制限
 def login():
     if request.method == 'OPTIONS':
@@ -202,10 +2001,13 @@ def login():
         if len(password) < 6 or len(password) > 128:
             return jsonify({'success': False, 'error': 'Invalid password length'}), 400
         
-        session = requests.Session()
+        session = new_upstream_session()
         
         try:
-            login_page = session.get(f'{BASE_URL}/users/sign_in', timeout=10)
+            # 🔒 ログイン中はメールアドレスのハッシュ単位で公平に扱う
+            owner = f"login:{hashlib.sha256(email.encode()).hexdigest()}"
+            login_page = upstream_scheduler.call(owner, session.get, f'{BASE_URL}/users/sign_in', timeout=10)
+            from bs4 import BeautifulSoup
             soup = BeautifulSoup(login_page.text, 'html.parser')
             token_input = soup.find('input', {'name': 'authenticity_token'})
             
@@ -215,7 +2017,9 @@ def login():
             
             csrf_token = token_input.get('value')
             
-            login_response = session.post(
+            login_response = upstream_scheduler.call(
+                owner,
+                session.post,
                 f'{BASE_URL}/users/sign_in',
                 data={
                     'user[email]': email,
@@ -229,11 +2033,14 @@ def login():
             if login_response.status_code == 200:
                 if 'store_visit_applications' in login_response.url or 'players' in login_response.url:
                     # 🔒 セキュアなセッション作成
-                    session_id = session_manager.create_session(email)
-                    session_manager.sessions[session_id]['session'] = session
+                    session_id = session_manager.create_session(email, session)
                     
                     logger.info(f"Login successful for email hash: {hashlib.sha256(email.encode()).hexdigest()[:8]}...")
                     
+                    # 🔥 最初のダッシュボード表示に使うデータを先読み
+                    if PREFETCH_ON_LOGIN:
+                        start_login_prefetch(session_manager.get_session_data(session_id))
+                    
                     return jsonify({
                         'success': True,
                         'session_id': session_id,
@@ -250,13 +2057,344 @@ def login():
             logger.error(f"Login error: {sanitize_error_message(e)}")
             return jsonify({'success': False, 'error': 'Authentication failed'}), 500
     
-    except Exception as e:
-        logger.error(f"Unexpected error in login: {sanitize_error_message(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+    except Exception as e:
+        logger.error(f"Unexpected error in login: {sanitize_error_message(e)}")
+        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+
+@routes.route('/proxy/api/chip_histories', methods=['GET', 'OPTIONS'])
+@limiter.limit("100 per minute")
+def get_chip_histories():
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    session_id = request.headers.get('X-Session-ID')
+    
+    # 🔒 セッション検証
+    if not session_id:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    session_data = session_manager.get_session_data(session_id)
+    if not session_data:
+        return jsonify({'success': False, 'error': 'Session expired'}), 401
+    
+    store_id = request.args.get('store_id', '6')
+    month = request.args.get('month')
+    
+    # 🔒 入力検証
+    if not validate_store_id(store_id):
+        return jsonify({'success': False, 'error': 'Invalid store ID'}), 400
+    
+    if month and not validate_month(month):
+        return jsonify({'success': False, 'error': 'Invalid month format'}), 400
+    
+    try:
+        chip_data = submit_month_fetch(session_data, store_id, month).result()
+        
+        return rows_response({
+            'success': True,
+            'data': chip_data
+        }, conditional=True)
+        
+    except UpstreamError:
+        return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
+    except requests.Timeout:
+        return jsonify({'success': False, 'error': 'Request timeout'}), 504
+    except Exception as e:
+        logger.error(f"Error fetching chip histories: {sanitize_error_message(e)}")
+        return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
+
+@routes.route('/proxy/api/stores', methods=['GET', 'OPTIONS'])
+@limiter.limit("50 per minute")
+def get_stores():
+    """Get available stores list"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    session_id = request.headers.get('X-Session-ID')
+    
+    # 🔒 セッション検証
+    if not session_id:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    session_data = session_manager.get_session_data(session_id)
+    if not session_data:
+        return jsonify({'success': False, 'error': 'Session expired'}), 401
+    
+    try:
+        # ⚡ ログイン直後の先読みで取得済みならキャッシュから返す
+        stores = submit_store_list_fetch(session_data).result()
+        
+        return encoded_response({
+            'success': True,
+            'stores': stores
+        }, conditional=True)
+        
+    except requests.Timeout:
+        return jsonify({'success': False, 'error': 'Request timeout'}), 504
+    except Exception as e:
+        logger.error(f"Error fetching stores: {sanitize_error_message(e)}")
+        return jsonify({'success': False, 'error': 'Failed to fetch stores'}), 500
+
+@routes.route('/proxy/api/chip_histories_batch', methods=['POST', 'OPTIONS'])
+@limiter.limit("20 per minute")
+def get_chip_histories_batch():
+    """Batch fetch chip histories for multiple months with parallel processing"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    session_id = request.headers.get('X-Session-ID')
+    
+    # 🔒 セッション検証
+    if not session_id:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    session_data = session_manager.get_session_data(session_id)
+    if not session_data:
+        return jsonify({'success': False, 'error': 'Session expired'}), 401
+    
+    data = request.json
+    
+    # 🔒 入力検証
+    store_ids, months, error = parse_batch_params(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    multi_store = 'store_ids' in data
+    batch_fanout.observe(len(store_ids) * len(months))
+    deadline = parse_batch_deadline(data)
+    
+    # ⚡ ストリーミング応答（NDJSON）: 各月の取得完了ごとに逐次送信
+    if preferred_mimetype(('application/x-ndjson',)) == 'application/x-ndjson':
+        return Response(
+            stream_batch_frames(session_data, store_ids, months, multi_store, deadline),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    
+    try:
+        rows_by_store = {store_id: [] for store_id in store_ids}
+        failed_by_store = {store_id: [] for store_id in store_ids}
+        missing_by_store = {store_id: [] for store_id in store_ids}
+        
+        # 🔒 並列処理（共有スケジューラ経由で全ユーザー合計の同時実行数を制限）
+        future_to_task = submit_grid_fetch(session_data, store_ids, months)
+        
+        # ⏱️ 締め切りまでに取得できた月だけを使う
+        for future in completed_before(future_to_task, deadline):
+            store_id, month = future_to_task[future]
+            try:
+                rows_by_store[store_id].append(future.result())
+            except Exception as e:
+                logger.warning(f"Error fetching month {month} (store {store_id}): {sanitize_error_message(e)}")
+                failed_by_store[store_id].append(month)
+        for store_id, month in cancel_unfinished(future_to_task):
+            missing_by_store[store_id].append(month)
+        status_fields = month_status_fields(store_ids, failed_by_store, missing_by_store, multi_store)
+        
+        # ⚡ 複数店舗の場合は店舗ごとに重複除去してまとめて返す
+        if multi_store:
+            return rows_response({
+                'success': True,
+                'by_store': {
+                    store_id: dedupe_and_sort_rows(rows)
+                    for store_id, rows in rows_by_store.items()
+                },
+                **status_fields
+            })
+        
+        sorted_data = dedupe_and_sort_rows(rows_by_store[store_ids[0]])
+        
+        return rows_response({
+            'success': True,
+            'data': sorted_data,
+            **status_fields
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in batch fetch: {sanitize_error_message(e)}")
+        return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
+
+def parse_store_ids(data: dict):
+    """リクエストの店舗IDを検証して (重複を除いた store_ids, error) を返す"""
+    # store_ids（複数店舗）が無ければ従来どおり store_id（単一店舗）
+    store_ids = data.get('store_ids', [data.get('store_id', '6')])
+    
+    if not store_ids or not isinstance(store_ids, list):
+        return None, 'No stores provided'
+    
+    # 🔒 店舗数制限（DoS対策）
+    if len(store_ids) > MAX_BATCH_STORES:
+        return None, 'Too many stores requested'
+    
+    for store_id in store_ids:
+        if not isinstance(store_id, str) or not validate_store_id(store_id):
+            return None, 'Invalid store ID'
+    
+    return list(dict.fromkeys(store_ids)), None
+
+def parse_batch_params(data):
+    """バッチ取得のパラメータを検証して (store_ids, months, error) を返す"""
+    if not isinstance(data, dict):
+        return None, None, 'Invalid request body'
+    
+    store_ids, error = parse_store_ids(data)
+    if error:
+        return None, None, error
+    
+    months = data.get('months', [])
+    if not months or not isinstance(months, list):
+        return None, None, 'No months provided'
+    
+    # 🔒 月数制限（DoS対策）
+    if len(months) > 24:
+        return None, None, 'Too many months requested'
+    
+    # 🔒 各月の形式検証
+    for month in months:
+        if not isinstance(month, str) or not validate_month(month):
+            return None, None, f'Invalid month format: {month}'
+    
+    return store_ids, list(dict.fromkeys(months)), None
 
-@app.route('/proxy/api/chip_histories', methods=['GET', 'OPTIONS'])
-@limiter.limit("100 per minute")
-def get_chip_histories():
+def submit_grid_fetch(session_data, store_ids, months):
+    """店舗×月の全組み合わせを投入し {Future: (store_id, month)} を返す"""
+    return {
+        submit_month_fetch(session_data, store_id, month): (store_id, month)
+        for month in months
+        for store_id in store_ids
+    }
+
+def parse_batch_deadline(data) -> float:
+    """締め切りの時刻（time.monotonic 基準）。deadline_ms で短くできる（上限 BATCH_DEADLINE）"""
+    budget = BATCH_DEADLINE
+    value = data.get('deadline_ms')
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+        budget = min(BATCH_DEADLINE, max(BATCH_MIN_DEADLINE, value / 1000))
+    return time.monotonic() + budget
+
+def completed_before(future_to_task, deadline: float):
+    """締め切りまでに完了した Future を完了順に返す"""
+    try:
+        yield from as_completed(future_to_task, timeout=max(0.0, deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        logger.warning("Batch deadline exceeded, returning partial results")
+
+def cancel_unfinished(future_to_task) -> list:
+    """未完了の取得をキャンセルし、その (store_id, month) の一覧を返す"""
+    unfinished = []
+    for future, task in future_to_task.items():
+        if not future.done():
+            future.cancel()
+            unfinished.append(task)
+    return unfinished
+
+def month_status_fields(store_ids, failed_by_store, missing_by_store, multi_store=False) -> dict:
+    """取得に失敗した月・締め切りに間に合わなかった月（クライアントが後で再取得する）"""
+    failed = {store_id: sorted(failed_by_store[store_id]) for store_id in store_ids}
+    missing = {store_id: sorted(missing_by_store[store_id]) for store_id in store_ids}
+    return {
+        'partial': any(failed.values()) or any(missing.values()),
+        'failed_months': failed if multi_store else failed[store_ids[0]],
+        'missing_months': missing if multi_store else missing[store_ids[0]],
+    }
+
+row_date = itemgetter('date')
+# 行の同一性（日時・店舗・残高の推移）。同じ日時に複数のセッションがあっても区別する
+row_identity = itemgetter('date', 'store_name', 'current_balance', 'total_change')
+
+def merge_month_rows(month_rows):
+    """月ごとの行リストを k-way マージし、重複を除いて日付の新しい順に返す
+
+    月ごとのページは日付が重ならないため、通常は新しい月から順に連結するだけで済む
+    （同じ月が重複している場合のみ heapq.merge）。重複する行は日時が同じなので
+    隣り合い、同じ日時の間だけ同一性を覚えておけばよい。
+    """
+    runs = sorted(
+        (sorted(rows, key=row_date, reverse=True) for rows in month_rows if rows),
+        key=lambda run: row_date(run[0]), reverse=True
+    )
+    if all(row_date(newer[-1]) >= row_date(older[0]) for newer, older in pairwise(runs)):
+        merged = chain.from_iterable(runs)
+    else:
+        merged = heapq.merge(*runs, key=row_date, reverse=True)
+    
+    current_date = None
+    seen = set()
+    for row in merged:
+        date = row_date(row)
+        if date != current_date:
+            current_date = date
+            seen.clear()
+        identity = row_identity(row)
+        if identity not in seen:
+            seen.add(identity)
+            yield row
+
+def dedupe_and_sort_rows(month_rows):
+    """月ごとの行リストのリストを重複除去して日付の新しい順に並べる"""
+    started = time.perf_counter()
+    rows = list(merge_month_rows(month_rows))
+    record_span('dedupe_and_sort', started, rows_in=sum(map(len, month_rows)), rows_out=len(rows))
+    return rows
+
+def ndjson_frame(frame: dict) -> str:
+    """NDJSONの1行を生成"""
+    return json.dumps(frame, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+def stream_batch_frames(session_data, store_ids, months, multi_store=False, deadline=None):
+    """月ごとのデータ・進捗・最終サマリーをNDJSONフレームとして順に生成
+
+    フレーム種別:
+      {"type": "month", "store_id": "6", "month": "2025-01", "data": [...]}
+      {"type": "progress", "completed": 12, "total": 24}
+      {"type": "summary", "success": true, "total_rows": 408, "partial": false,
+       "failed_months": [...], "missing_months": [...]}
+    複数店舗の場合 total_rows・failed_months・missing_months は店舗IDごとの辞書になる。
+    """
+    rows_by_store = {store_id: [] for store_id in store_ids}
+    failed_by_store = {store_id: [] for store_id in store_ids}
+    missing_by_store = {store_id: [] for store_id in store_ids}
+    completed = 0
+    
+    if deadline is None:
+        deadline = time.monotonic() + BATCH_DEADLINE
+    future_to_task = submit_grid_fetch(session_data, store_ids, months)
+    total = len(future_to_task)
+    try:
+        for future in completed_before(future_to_task, deadline):
+            store_id, month = future_to_task[future]
+            completed += 1
+            try:
+                month_data = future.result()
+            except Exception as e:
+                logger.warning(f"Error fetching month {month} (store {store_id}): {sanitize_error_message(e)}")
+                failed_by_store[store_id].append(month)
+            else:
+                rows_by_store[store_id].append(month_data)
+                yield ndjson_frame({'type': 'month', 'store_id': store_id, 'month': month, 'data': month_data})
+            yield ndjson_frame({'type': 'progress', 'completed': completed, 'total': total})
+        for store_id, month in cancel_unfinished(future_to_task):
+            missing_by_store[store_id].append(month)
+        
+        total_rows = {
+            store_id: sum(1 for _ in merge_month_rows(month_rows))
+            for store_id, month_rows in rows_by_store.items()
+        }
+        yield ndjson_frame({
+            'type': 'summary',
+            'success': True,
+            'total_rows': total_rows if multi_store else total_rows[store_ids[0]],
+            **month_status_fields(store_ids, failed_by_store, missing_by_store, multi_store)
+        })
+    finally:
+        # クライアント切断時は未着手の取得をキャンセル
+        for future in future_to_task:
+            future.cancel()
+
+# 📊 サーバー側集計エンドポイント
+@routes.route('/proxy/api/summary', methods=['POST', 'OPTIONS'])
+@limiter.limit("20 per minute")
+def get_summary():
+    """統計情報（全体・月別・店舗別・曜日別・直近期間・累積推移）を返す"""
     if request.method == 'OPTIONS':
         return '', 204
     
@@ -266,48 +2404,65 @@ def get_chip_histories():
     if not session_id:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
-    session = session_manager.get_session(session_id)
-    if not session:
+    session_data = session_manager.get_session_data(session_id)
+    if not session_data:
         return jsonify({'success': False, 'error': 'Session expired'}), 401
     
-    store_id = request.args.get('store_id', '6')
-    month = request.args.get('month')
+    data = request.json
     
     # 🔒 入力検証
-    if not validate_store_id(store_id):
-        return jsonify({'success': False, 'error': 'Invalid store ID'}), 400
+    store_ids, months, error = parse_batch_params(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
     
-    if month and not validate_month(month):
-        return jsonify({'success': False, 'error': 'Invalid month format'}), 400
+    windows = data.get('windows', DEFAULT_SUMMARY_WINDOWS)
+    if (not isinstance(windows, list) or len(windows) > 5
+            or not all(isinstance(w, int) and 1 <= w <= 3660 for w in windows)):
+        return jsonify({'success': False, 'error': 'Invalid windows'}), 400
     
     try:
-        if month:
-            url = f'{BASE_URL}/players/chip_histories?month={month}&store_id={store_id}'
-        else:
-            url = f'{BASE_URL}/players/chip_histories?store_id={store_id}'
+        rows_by_store = {store_id: {} for store_id in store_ids}
+        failed_months = []
         
-        response = session.get(url, timeout=10)
-        
-        if response.status_code != 200:
-            return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
+        future_to_task = submit_grid_fetch(session_data, store_ids, months)
+        for future in completed_before(future_to_task, parse_batch_deadline(data)):
+            store_id, month = future_to_task[future]
+            try:
+                rows_by_store[store_id][month] = future.result()
+            except Exception as e:
+                logger.warning(f"Error fetching month {month} (store {store_id}): {sanitize_error_message(e)}")
+                failed_months.append({'store_id': store_id, 'month': month})
+        missing_months = [
+            {'store_id': store_id, 'month': month}
+            for store_id, month in cancel_unfinished(future_to_task)
+        ]
         
-        chip_data = parse_chip_history(response.text)
+        columns = summary_columns(session_data['email_hash'], rows_by_store)
         
         return jsonify({
             'success': True,
-            'data': chip_data
+            'summary': summarize_columns(columns, windows),
+            'partial': bool(failed_months or missing_months),
+            'failed_months': failed_months,
+            'missing_months': missing_months
         })
         
-    except requests.Timeout:
-        return jsonify({'success': False, 'error': 'Request timeout'}), 504
     except Exception as e:
-        logger.error(f"Error fetching chip histories: {sanitize_error_message(e)}")
+        logger.error(f"Error in summary: {sanitize_error_message(e)}")
         return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
 
-@app.route('/proxy/api/stores', methods=['GET', 'OPTIONS'])
-@limiter.limit("50 per minute")
-def get_stores():
-    """Get available stores list"""
+# 🔄 差分同期エンドポイント（クライアントのローカル保存データとの同期）
+@routes.route('/proxy/api/chip_histories_sync', methods=['POST', 'OPTIONS'])
+@limiter.limit("30 per minute")
+def sync_chip_histories():
+    """カーソル（店舗ごとの最後に保存した行の日付・残高）より新しい行だけを返す
+
+    リクエスト: {"store_id": "6", "cursors": {"6": {"date": "...", "balance": 123}}, "since": "2024-01"}
+    カーソルの無い店舗は since の月から全件を返す。
+    応答の cursor を次回の同期に使う。replace_from が月の場合、カーソルの行が上流に
+    見つからなかったため、その月以降のローカルの行を data で置き換える。
+    historical_revalidated は当月より前の月を上流から取り直したか（確定済みの月は取り直さない）。
+    """
     if request.method == 'OPTIONS':
         return '', 204
     
@@ -317,42 +2472,175 @@ def get_stores():
     if not session_id:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
-    session = session_manager.get_session(session_id)
-    if not session:
+    session_data = session_manager.get_session_data(session_id)
+    if not session_data:
         return jsonify({'success': False, 'error': 'Session expired'}), 401
     
+    data = request.json
+    
+    # 🔒 入力検証
+    store_ids, cursors, months_by_store, error = parse_sync_params(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    multi_store = 'store_ids' in data
+    
     try:
-        response = session.get(f'{BASE_URL}/players/chip_histories', timeout=10)
+        email_hash = session_data['email_hash']
+        rows_by_month = {store_id: {} for store_id in store_ids}
+        failed_by_store = {store_id: [] for store_id in store_ids}
+        missing_by_store = {store_id: [] for store_id in store_ids}
+        revalidated = {
+            store_id: any(
+                month < current_month() and get_cached_month_rows(email_hash, store_id, month) is None
+                for month in months
+            )
+            for store_id, months in months_by_store.items()
+        }
         
-        if response.status_code != 200:
-            return jsonify({'success': False, 'error': 'Failed to fetch stores'}), 500
+        future_to_task = {
+            submit_month_fetch(session_data, store_id, month): (store_id, month)
+            for store_id, months in months_by_store.items()
+            for month in months
+        }
+        for future in completed_before(future_to_task, parse_batch_deadline(data)):
+            store_id, month = future_to_task[future]
+            try:
+                rows_by_month[store_id][month] = future.result()
+            except Exception as e:
+                logger.warning(f"Error fetching month {month} (store {store_id}): {sanitize_error_message(e)}")
+                failed_by_store[store_id].append(month)
+        for store_id, month in cancel_unfinished(future_to_task):
+            missing_by_store[store_id].append(month)
         
-        soup = BeautifulSoup(response.text, 'html.parser')
-        stores = []
+        results = {
+            store_id: sync_store_rows(cursors.get(store_id), months_by_store[store_id], rows_by_month[store_id])
+            for store_id in store_ids
+        }
+        status_fields = month_status_fields(store_ids, failed_by_store, missing_by_store, multi_store)
         
-        store_select = soup.find('select', {'name': 'store_id'})
-        if store_select:
-            for option in store_select.find_all('option'):
-                stores.append({
-                    'id': option.get('value'),
-                    'name': option.get_text(strip=True)
-                })
+        if multi_store:
+            return rows_response({
+                'success': True,
+                'by_store': {store_id: result[0] for store_id, result in results.items()},
+                'cursors': {store_id: result[1] for store_id, result in results.items()},
+                'replace_from': {store_id: result[2] for store_id, result in results.items()},
+                'historical_revalidated': revalidated,
+                **status_fields
+            })
         
-        return jsonify({
+        rows, cursor, replace_from = results[store_ids[0]]
+        return rows_response({
             'success': True,
-            'stores': stores
+            'data': rows,
+            'cursor': cursor,
+            'replace_from': replace_from,
+            'historical_revalidated': revalidated[store_ids[0]],
+            **status_fields
         })
         
-    except requests.Timeout:
-        return jsonify({'success': False, 'error': 'Request timeout'}), 504
     except Exception as e:
-        logger.error(f"Error fetching stores: {sanitize_error_message(e)}")
-        return jsonify({'success': False, 'error': 'Failed to fetch stores'}), 500
+        logger.error(f"Error in sync: {sanitize_error_message(e)}")
+        return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
 
-@app.route('/proxy/api/chip_histories_batch', methods=['POST', 'OPTIONS'])
-@limiter.limit("20 per minute")
-def get_chip_histories_batch():
-    """Batch fetch chip histories for multiple months with parallel processing"""
+def month_range(start: str, end: str) -> list:
+    """start から end までの月 (YYYY-MM) を古い順に"""
+    year, month = map(int, start.split('-'))
+    months = []
+    while f'{year:04d}-{month:02d}' <= end:
+        months.append(f'{year:04d}-{month:02d}')
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+    return months
+
+def parse_sync_params(data):
+    """差分同期のパラメータを検証して (store_ids, cursors, {store_id: 月リスト}, error) を返す"""
+    if not isinstance(data, dict):
+        return None, None, None, 'Invalid request body'
+    
+    store_ids, error = parse_store_ids(data)
+    if error:
+        return None, None, None, error
+    
+    cursors = data.get('cursors', {})
+    if not isinstance(cursors, dict):
+        return None, None, None, 'Invalid cursors'
+    since = data.get('since')
+    if since is not None and (not isinstance(since, str) or not validate_month(since)):
+        return None, None, None, f'Invalid month format: {since}'
+    
+    months_by_store = {}
+    for store_id in store_ids:
+        cursor = cursors.get(store_id)
+        if cursor is None:
+            if since is None:
+                return None, None, None, 'Cursor or since required'
+            start = since
+        else:
+            # 🔒 カーソルは {"date": "YYYY-MM-DD ...", "balance": 整数}
+            if (not isinstance(cursor, dict) or not isinstance(cursor.get('date'), str)
+                    or len(cursor['date']) > 32 or not validate_month(cursor['date'][:7].replace('/', '-'))
+                    or not isinstance(cursor.get('balance'), int) or isinstance(cursor['balance'], bool)):
+                return None, None, None, 'Invalid cursor'
+            start = cursor['date'][:7].replace('/', '-')
+        
+        months = month_range(start, current_month())
+        # 🔒 月数制限（DoS対策）。これより古いカーソルはバッチ取得で取り直す
+        if len(months) > 24:
+            return None, None, None, 'Too many months requested'
+        months_by_store[store_id] = months
+    
+    return store_ids, {store_id: cursors[store_id] for store_id in store_ids if store_id in cursors}, months_by_store, None
+
+def rows_after_cursor(rows, cursor):
+    """新しい順の行のうちカーソルの行より新しいもの（カーソルの行が見つからなければNone）"""
+    new_rows = []
+    for row in rows:
+        if row['date'] == cursor['date'] and row['current_balance'] == cursor['balance']:
+            return new_rows
+        if row['date'] < cursor['date']:
+            break
+        new_rows.append(row)
+    return None
+
+def sync_store_rows(cursor, months, rows_by_month):
+    """1店舗分の (新しい行, 次のカーソル, replace_from) を返す
+
+    取得できなかった月があれば、それより前の連続した月だけを使う（カーソルが抜けを飛び越えないように）。
+    """
+    available = []
+    for month in months:
+        if month not in rows_by_month:
+            break
+        available.append(rows_by_month[month])
+    rows = dedupe_and_sort_rows(available)
+    
+    replace_from = None
+    if cursor is not None:
+        new_rows = rows_after_cursor(rows, cursor)
+        if new_rows is not None:
+            rows = new_rows
+        elif available:
+            replace_from = months[0]
+    
+    if rows:
+        next_cursor = {'date': rows[0]['date'], 'balance': rows[0]['current_balance']}
+    else:
+        next_cursor = cursor if replace_from is None else None
+    return rows, next_cursor, replace_from
+
+# 📤 エクスポート（CSV / JSON Lines をストリーミング出力）
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),  # Flask が charset=utf-8 を付ける
+    'ndjson': ('application/x-ndjson', 'jsonl'),
+}
+
+@routes.route('/proxy/api/export', methods=['POST', 'OPTIONS'])
+@limiter.limit("5 per minute")
+def export_chip_histories():
+    """店舗・月ごとに取得・パースした行を、できた順に CSV / JSON Lines で返す
+
+    リクエスト: {"store_ids": ["6"], "since": "2020-01", "format": "csv"}（months で月を直接指定も可）
+    全期間を保持しないため、履歴の長さに関わらずメモリ使用量は一定。
+    """
     if request.method == 'OPTIONS':
         return '', 204
     
@@ -362,71 +2650,420 @@ def get_chip_histories_batch():
     if not session_id:
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
-    session = session_manager.get_session(session_id)
-    if not session:
+    session_data = session_manager.get_session_data(session_id)
+    if not session_data:
         return jsonify({'success': False, 'error': 'Session expired'}), 401
     
     data = request.json
-    store_id = data.get('store_id', '6')
-    months = data.get('months', [])
     
     # 🔒 入力検証
-    if not validate_store_id(store_id):
-        return jsonify({'success': False, 'error': 'Invalid store ID'}), 400
+    store_ids, months, error = parse_export_params(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    export_format = data.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': 'Invalid format'}), 400
     
-    if not months or not isinstance(months, list):
-        return jsonify({'success': False, 'error': 'No months provided'}), 400
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    lines = export_csv_lines if export_format == 'csv' else export_ndjson_lines
+    return Response(
+        lines(session_data, store_ids, months),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename="chip_histories.{extension}"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+def parse_export_params(data):
+    """エクスポートのパラメータを検証して (store_ids, 月リスト（新しい順）, error) を返す"""
+    if not isinstance(data, dict):
+        return None, None, 'Invalid request body'
     
-    # 🔒 月数制限（DoS対策）
-    if len(months) > 24:
-        return jsonify({'success': False, 'error': 'Too many months requested'}), 400
+    store_ids, error = parse_store_ids(data)
+    if error:
+        return None, None, error
     
-    # 🔒 各月の形式検証
-    for month in months:
-        if not validate_month(month):
-            return jsonify({'success': False, 'error': f'Invalid month format: {month}'}), 400
+    since = data.get('since')
+    if since is not None:
+        if not isinstance(since, str) or not validate_month(since):
+            return None, None, f'Invalid month format: {since}'
+        months = month_range(since, current_month())
+    else:
+        months = data.get('months', [])
+        if not months or not isinstance(months, list):
+            return None, None, 'No months provided'
+        for month in months:
+            if not isinstance(month, str) or not validate_month(month):
+                return None, None, f'Invalid month format: {month}'
     
+    # 🔒 月数制限（DoS対策）
+    if len(months) > EXPORT_MAX_MONTHS:
+        return None, None, 'Too many months requested'
+    
+    return store_ids, sorted(set(months), reverse=True), None
+
+def iter_month_rows(session_data, tasks, window=EXPORT_PREFETCH_MONTHS):
+    """(store_id, month) の順に行を返す（先の window 件を先行して取得し、待ち時間を重ねる）
+
+    取得に失敗した月があれば例外を送出する（途中で途切れた応答としてクライアントに伝わる）。
+    """
+    tasks = iter(tasks)
+    pending = deque(
+        (task, submit_month_fetch(session_data, *task)) for task in islice(tasks, window)
+    )
     try:
-        all_chip_data = []
-        
-        def fetch_month_data(month):
-            url = f'{BASE_URL}/players/chip_histories?month={month}&store_id={store_id}'
+        while pending:
+            task, future = pending.popleft()
+            next_task = next(tasks, None)
+            if next_task is not None:
+                pending.append((next_task, submit_month_fetch(session_data, *next_task)))
             try:
-                response = session.get(url, timeout=10)
-                if response.status_code == 200:
-                    return parse_chip_history(response.text)
+                rows = future.result()
             except Exception as e:
-                logger.warning(f"Error fetching month {month}: {sanitize_error_message(e)}")
-            return []
-        
-        # 🔒 並列処理（最大10並列）
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_month = {executor.submit(fetch_month_data, month): month for month in months}
-            
-            for future in as_completed(future_to_month):
-                month_data = future.result()
-                all_chip_data.extend(month_data)
-        
-        # 🔒 重複除去（日付とstore_idで）
-        unique_data = {}
-        for item in all_chip_data:
-            key = f"{item.get('date')}_{item.get('store_id')}"
-            if key not in unique_data:
-                unique_data[key] = item
-        
-        sorted_data = sorted(unique_data.values(), key=lambda x: x.get('date', ''), reverse=True)
-        
-        return jsonify({
-            'success': True,
-            'data': sorted_data
-        })
-        
-    except Exception as e:
-        logger.error(f"Error in batch fetch: {sanitize_error_message(e)}")
-        return jsonify({'success': False, 'error': 'Failed to fetch data'}), 500
+                logger.warning(f"Export aborted at month {task[1]} (store {task[0]}): {sanitize_error_message(e)}")
+                raise
+            yield task, rows
+    finally:
+        # クライアントの切断・失敗時は先行取得をキャンセル
+        for _, future in pending:
+            future.cancel()
+
+def export_months(session_data, store_ids, months):
+    """店舗ごとに新しい月から (store_id, 重複除去した行) を順に生成"""
+    tasks = ((store_id, month) for store_id in store_ids for month in months)
+    for (store_id, month), rows in iter_month_rows(session_data, tasks):
+        yield store_id, merge_month_rows([rows])
+
+def export_csv_lines(session_data, store_ids, months):
+    """CSV（Excelで文字化けしないようBOM付きUTF-8）を月ごとに生成"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    def drain() -> str:
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+    
+    writer.writerow(('store_id', *ROW_FIELDS))
+    yield '\ufeff' + drain()
+    for store_id, rows in export_months(session_data, store_ids, months):
+        writer.writerows((store_id, *(row.get(field) for field in ROW_FIELDS)) for row in rows)
+        text = drain()
+        if text:
+            yield text
+
+def export_ndjson_lines(session_data, store_ids, months):
+    """1行1オブジェクトの JSON Lines を月ごとに生成"""
+    for store_id, rows in export_months(session_data, store_ids, months):
+        text = ''.join(ndjson_frame({'store_id': store_id, **row}) for row in rows)
+        if text:
+            yield text
+
+# 📊 列指向のチップ履歴
+class ChipColumns:
+    """チップ履歴の行を列ごとの配列（古い順）で保持する集計用の表現"""
+    INT_FIELDS = ('ring_chips', 'tournament_chips', 'purchase', 'total_change', 'current_balance')
+    
+    def __init__(self):
+        self.dates = []
+        self.store_ids = []
+        self.ordinals = array('l')  # 日付の通し日数（解釈できない日付は0）
+        self.weekdays = array('b')  # 0=月曜 ... 6=日曜（解釈できない日付は-1）
+        self.fields = {name: array('q') for name in self.INT_FIELDS}
+    
+    def __len__(self):
+        return len(self.dates)
+    
+    def append(self, store_id, row):
+        """1行を末尾に追加"""
+        date_text = row.get('date', '')
+        self.dates.append(date_text)
+        self.store_ids.append(store_id)
+        day = parse_row_date(date_text)
+        self.ordinals.append(day.toordinal() if day else 0)
+        self.weekdays.append(day.weekday() if day else -1)
+        for name, values in self.fields.items():
+            values.append(row.get(name, 0))
+
+def parse_row_date(date_text):
+    """行の日付文字列（YYYY-MM-DD / YYYY/MM/DD、時刻付き可）を date に変換"""
+    try:
+        return datetime.strptime(date_text[:10].replace('/', '-'), '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def compute_statistics(columns, indices=None) -> dict:
+    """クライアントの統計カードと同じ指標を計算"""
+    ring = columns.fields['ring_chips']
+    tournament = columns.fields['tournament_chips']
+    change = columns.fields['total_change']
+    if indices is not None:
+        ring = [ring[i] for i in indices]
+        tournament = [tournament[i] for i in indices]
+        change = [change[i] for i in indices]
+    
+    count = len(change)
+    if count == 0:
+        return {
+            'total_sessions': 0, 'total_ring': 0, 'total_tournament': 0, 'total_profit': 0,
+            'avg_profit': 0.0, 'win_rate': 0.0, 'max_profit_day': 0, 'min_profit_day': 0,
+            'plus_days': 0, 'minus_days': 0, 'avg_ring': 0.0, 'avg_tournament': 0.0,
+        }
+    
+    total_ring = sum(ring)
+    total_tournament = sum(tournament)
+    total_profit = sum(change)
+    plus_days = sum(1 for value in change if value > 0)
+    minus_days = sum(1 for value in change if value < 0)
+    return {
+        'total_sessions': count,
+        'total_ring': total_ring,
+        'total_tournament': total_tournament,
+        'total_profit': total_profit,
+        'avg_profit': total_profit / count,
+        'win_rate': plus_days / count * 100,
+        'max_profit_day': max(change),
+        'min_profit_day': min(change),
+        'plus_days': plus_days,
+        'minus_days': minus_days,
+        'avg_ring': total_ring / count,
+        'avg_tournament': total_tournament / count,
+    }
+
+def group_indices(keys) -> dict:
+    """キーの列から {キー: 行番号リスト} を作成"""
+    groups = {}
+    for index, key in enumerate(keys):
+        groups.setdefault(key, []).append(index)
+    return groups
+
+def summarize_columns(columns, windows) -> dict:
+    """全体・月別・店舗別・曜日別・直近N日・累積推移の集計"""
+    by_month = group_indices(date[:7] for date in columns.dates)
+    by_store = group_indices(columns.store_ids)
+    by_weekday = group_indices(columns.weekdays)
+    by_weekday.pop(-1, None)
+    
+    rolling = {}
+    latest = max(columns.ordinals, default=0)
+    for window in windows:
+        start = latest - window + 1
+        indices = [i for i, day in enumerate(columns.ordinals) if day and day >= start]
+        rolling[str(window)] = compute_statistics(columns, indices)
+    
+    return {
+        'overall': compute_statistics(columns),
+        'by_month': {key: compute_statistics(columns, idx) for key, idx in sorted(by_month.items())},
+        'by_store': {key: compute_statistics(columns, idx) for key, idx in by_store.items()},
+        'by_weekday': {str(key): compute_statistics(columns, idx) for key, idx in sorted(by_weekday.items())},
+        'rolling': rolling,
+        'cumulative': {
+            'dates': columns.dates,
+            'total': list(accumulate(columns.fields['total_change'])),
+            'ring': list(accumulate(columns.fields['ring_chips'])),
+            'tournament': list(accumulate(columns.fields['tournament_chips'])),
+        },
+    }
+
+def summary_columns(email_hash, rows_by_store):
+    """{store_id: {month: rows}} から列データを作成（同じ行リストなら再利用）"""
+    layout = tuple(
+        (store_id, tuple(sorted(by_month)))
+        for store_id, by_month in rows_by_store.items()
+    )
+    # チップ履歴キャッシュに相乗りして容量上限（CHIP_CACHE_MAX_BYTES）に含める。
+    # 3番目の要素（最新の月）が当月なら当月と同じTTLで期限切れになる
+    key = (email_hash, ('summary', layout), max((month for _, months in layout for month in months), default=''))
+    sources = tuple(
+        by_month[month]
+        for store_id, by_month in rows_by_store.items()
+        for month in sorted(by_month)
+    )
+    
+    entry = chip_cache.get(key)
+    # 元の行リストが同一オブジェクトのままなら結果も同じ
+    if entry is not None and len(entry[0]) == len(sources) and all(
+        a is b for a, b in zip(entry[0], sources)
+    ):
+        return entry[1]
+    
+    # 店舗ごとに重複除去した上で、全店舗を古い順にマージする
+    runs = [
+        [(row, store_id) for row in reversed(dedupe_and_sort_rows([by_month[month] for month in sorted(by_month)]))]
+        for store_id, by_month in rows_by_store.items()
+    ]
+    
+    columns = ChipColumns()
+    for row, store_id in heapq.merge(*runs, key=lambda item: item[0]['date']):
+        columns.append(store_id, row)
+    
+    # 元の行リストも保持するため、その分も含めて見積もる（月のキャッシュと重複しても安全側）
+    size = estimate_columns_size(columns) + sum(estimate_rows_size(rows) for rows in sources)
+    chip_cache.put(key, (sources, columns), size)
+    return columns
+
+def estimate_columns_size(columns) -> int:
+    """列データのおおよそのメモリ使用量（バイト）"""
+    size = sys.getsizeof(columns.dates) + sys.getsizeof(columns.store_ids)
+    size += sum(sys.getsizeof(date) for date in columns.dates)
+    size += sys.getsizeof(columns.ordinals) + sys.getsizeof(columns.weekdays)
+    return size + sum(sys.getsizeof(values) for values in columns.fields.values())
+
+DEFAULT_SUMMARY_WINDOWS = [7, 30, 90]
+
+# 🔒 統計・メトリクスは利用者数やセッション数が分かるため管理者のみ
+def metrics_token_valid() -> bool:
+    """Authorization: Bearer <METRICS_TOKEN> が一致するか（トークン未設定なら常に拒否）"""
+    return bool(METRICS_TOKEN) and secrets.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'
+    )
+
+# 🔒 上流スケジューラ統計エンドポイント
+@routes.route('/proxy/api/upstream_stats', methods=['GET'])
+@limiter.limit("30 per minute")
+def get_upstream_stats():
+    """上流リクエストのキュー長・待ち時間を返す"""
+    if not metrics_token_valid():
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return jsonify({
+        'success': True,
+        'scheduler': upstream_scheduler.stats(),
+        'single_flight': month_fetch_flight.stats()
+    })
+
+# ⚡ キャッシュ統計エンドポイント
+@routes.route('/proxy/api/cache_stats', methods=['GET'])
+@limiter.limit("30 per minute")
+def get_cache_stats():
+    """チップ履歴キャッシュのヒット/ミス数を返す"""
+    if not metrics_token_valid():
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return jsonify({
+        'success': True,
+        'cache': chip_cache.stats(),
+        'store': chip_store.stats() if chip_store else None,
+        'sessions': session_manager.stats()
+    })
+
+# 📈 メトリクス（Prometheus）
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = (request.endpoint or 'unmatched').rsplit('.', 1)[-1]
+        request_latency.observe(time.perf_counter() - started, endpoint, request.method)
+        request_count.inc(endpoint, str(response.status_code))
+    return response
+
+metrics.gauge('junpo_active_sessions', 'ログイン中のセッション数', lambda: session_manager.backend.count())
+metrics.gauge('junpo_upstream_active', '実行中の上流リクエスト数', lambda: upstream_scheduler.active)
+metrics.gauge('junpo_upstream_concurrency_limit', '上流リクエストの同時実行数の上限（自動調整）', lambda: upstream_scheduler.limit)
+metrics.gauge('junpo_upstream_queue_depth', 'スケジューラで待機中の上流リクエスト数', lambda: upstream_scheduler.queued)
+metrics.gauge('junpo_chip_cache_bytes', 'チップ履歴キャッシュの推定サイズ（バイト）', lambda: chip_cache.total_bytes)
+
+@routes.route('/metrics', methods=['GET'])
+@limiter.exempt
+def get_metrics():
+    """Prometheus テキスト形式のメトリクス（レート制限の対象外、トークン必須）"""
+    if not metrics_token_valid():
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# 🔍 リクエストトレース
+def trace_token_valid() -> bool:
+    """X-Trace-Token が管理者トークンと一致するか"""
+    return bool(TRACE_ADMIN_TOKEN) and secrets.compare_digest(
+        request.headers.get('X-Trace-Token', ''), TRACE_ADMIN_TOKEN
+    )
+
+def start_request_trace():
+    forced = trace_token_valid()
+    if not forced and not (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE):
+        return
+    g.trace_root = Span('request', {'endpoint': (request.endpoint or 'unmatched').rsplit('.', 1)[-1]})
+    g.trace_started_at = datetime.now().isoformat(timespec='milliseconds')
+    current_span.set(g.trace_root)
+    
+    # X-Trace-Profile: 1 で統計的CPUプロファイルも採取
+    g.trace_profiler = None
+    if forced and request.headers.get('X-Trace-Profile') == '1':
+        profiler = SamplingProfiler()
+        if profiler.start():
+            g.trace_profiler = profiler
+
+def finish_request_trace(response):
+    root = g.pop('trace_root', None)
+    if root is None:
+        return response
+    root.ended = time.perf_counter()
+    current_span.set(None)
+    profiler = g.pop('trace_profiler', None)
+    if profiler:
+        profiler.stop()
+    
+    trace_id = secrets.token_hex(8)
+    trace_buffer.add({
+        'id': trace_id,
+        'started_at': g.trace_started_at,
+        'endpoint': root.attrs['endpoint'],
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(root.duration() * 1000, 3),
+        'root': root,
+        'profile': profiler,
+    })
+    response.headers['X-Trace-ID'] = trace_id
+    return response
+
+def clear_request_trace(error=None):
+    # 例外で after_request が呼ばれなかった場合も後始末する（スレッドは使い回される）
+    current_span.set(None)
+    profiler = g.pop('trace_profiler', None)
+    if profiler:
+        profiler.stop()
+
+@routes.route('/proxy/api/traces', methods=['GET'])
+@limiter.limit("30 per minute")
+def get_traces():
+    """トレースの一覧・詳細（?id=...&format=collapsed で flamegraph 形式、&source=profile でCPUプロファイル）"""
+    if not TRACE_ADMIN_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    if not trace_token_valid():
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    trace_id = request.args.get('id')
+    if not trace_id:
+        return jsonify({'success': True, 'traces': trace_buffer.summaries()})
+    trace = trace_buffer.get(trace_id)
+    if trace is None:
+        return jsonify({'success': False, 'error': 'Trace not found'}), 404
+    
+    if request.args.get('format') == 'collapsed':
+        if request.args.get('source') == 'profile':
+            if trace['profile'] is None:
+                return jsonify({'success': False, 'error': 'No profile for this trace'}), 404
+            lines = trace['profile'].collapsed()
+        else:
+            lines = trace['root'].collapsed()
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+    
+    result = {key: value for key, value in trace.items() if key not in ('root', 'profile')}
+    result['spans'] = trace['root'].to_dict(trace['root'].started)
+    if trace['profile'] is not None:
+        result['profile'] = {
+            'interval_ms': trace['profile'].interval * 1000,
+            'samples': sum(trace['profile'].samples.values()),
+        }
+    return jsonify({'success': True, 'trace': result})
 
 # 🔒 ログアウトエンドポイント
-@app.route('/proxy/api/logout', methods=['POST', 'OPTIONS'])
+@routes.route('/proxy/api/logout', methods=['POST', 'OPTIONS'])
 def logout():
     if request.method == 'OPTIONS':
         return '', 204
@@ -439,14 +3076,24 @@ def logout():
     
     return jsonify({'success': True, 'message': 'Logged out'})
 
-# Parse chip history HTML
-def parse_chip_history(html_content):
-    """Parse chip history from HTML"""
-    soup = BeautifulSoup(html_content, 'html.parser')
+# ⚡ パーサー設定
+PARSER_ENGINE = os.environ.get('PARSER_ENGINE', 'fast')  # 'fast' or 'soup'
+PARSER_VERIFY_RATE = float(os.environ.get('PARSER_VERIFY_RATE', '0'))  # 差分検証のサンプリング率
+
+NUMBER_CLEAN_PATTERN = re.compile(r'[^\d-]')
+TAG_PATTERN = re.compile(r'<(/?)([a-z][a-z0-9]*)')
+# 表の手前でこれらが閉じていない場合、表の切り出しは安全でない
+RAW_SECTION_MARKERS = (('<script', '</script'), ('<style', '</style'), ('<!--', '-->'))
+
+def parse_number(text):
+    """チップ数の文字列を整数に変換（カンマ・記号を除去）"""
+    cleaned = NUMBER_CLEAN_PATTERN.sub('', text)
+    return int(cleaned) if cleaned and cleaned != '-' else 0
+
+def build_chip_rows(rows):
+    """<tr> 要素のリストからチップ履歴の行を生成"""
     chip_data = []
     
-    rows = soup.select('table tbody tr')
-    
     for row in rows:
         cols = row.find_all('td')
         if len(cols) >= 7:
@@ -459,10 +3106,6 @@ def parse_chip_history(html_content):
                 balance_text = cols[5].get_text(strip=True)
                 store_text = cols[6].get_text(strip=True)
                 
-                def parse_number(text):
-                    cleaned = re.sub(r'[^\d-]', '', text)
-                    return int(cleaned) if cleaned and cleaned != '-' else 0
-                
                 chip_data.append({
                     'date': date_text,
                     'ring_chips': parse_number(ring_text),
@@ -479,22 +3122,458 @@ def parse_chip_history(html_content):
     
     return chip_data
 
+# Parse chip history HTML
+def parse_chip_history_soup(html_content):
+    """Parse chip history from HTML (ページ全体を解析するフォールバック)"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    return build_chip_rows(soup.select('table tbody tr'))
+
+def in_raw_section(lowered, position) -> bool:
+    """指定位置がscript/style/コメントの内側かどうか"""
+    prefix = lowered[:position]
+    for opener, closer in RAW_SECTION_MARKERS:
+        last_open = prefix.rfind(opener)
+        if last_open != -1 and prefix.find(closer, last_open) == -1:
+            return True
+    return False
+
+def parse_chip_history_fast(html_content):
+    """表の部分だけを解析する高速パーサー（扱えないページはNoneを返す）"""
+    lowered = html_content.lower()
+    # 🔒 小文字化で長さが変わる文字（'İ' など）があると位置がずれるため全体解析に任せる
+    if len(lowered) != len(html_content):
+        return None
+    
+    # 🔒 script/style/コメント内の "<table" は読み飛ばす
+    start = lowered.find('<table')
+    while start != -1 and in_raw_section(lowered, start):
+        start = lowered.find('<table', start + 1)
+    if start == -1:
+        return None if '<table' in lowered else []
+    # 🔒 属性値の中の "<table"（title="<table>..." など）は表ではない
+    prefix = lowered[:start]
+    if prefix.rfind('<') > prefix.rfind('>'):
+        return None
+    
+    last_close = lowered.rfind('</table')
+    end = lowered.find('>', last_close) + 1 if last_close > start else 0
+    if end <= 0:
+        end = len(html_content)
+    # 🔒 最後の </table> より後ろに閉じていない表があると切り捨ててしまうため対象外
+    if '<table' in lowered[end:]:
+        return None
+    region = lowered[start:end]
+    
+    # 表の内部にscript/style/コメントがある場合も安全側に倒す
+    if any(opener in region for opener, _ in RAW_SECTION_MARKERS):
+        return None
+    
+    # 表の外側の要素を閉じる終了タグがあると木構造が変わるため対象外
+    open_counts = {}
+    for match in TAG_PATTERN.finditer(region):
+        is_end, name = match.groups()
+        if not is_end:
+            open_counts[name] = open_counts.get(name, 0) + 1
+        elif open_counts.get(name):
+            open_counts[name] -= 1
+        else:
+            return None
+    
+    from bs4 import BeautifulSoup, SoupStrainer
+    soup = BeautifulSoup(html_content[start:end], 'html.parser', parse_only=SoupStrainer('table'))
+    
+    # 単一の表・単一のtbodyなら CSS セレクタを使わずに行を取得
+    if region.count('<table') == 1 and region.count('<tbody') == 1:
+        tbody = soup.find('tbody')
+        if tbody is None or tbody.find_parent('table') is None:
+            return []
+        rows = tbody.find_all('tr')
+    else:
+        rows = soup.select('table tbody tr')
+    
+    return build_chip_rows(rows)
+
+def parse_chip_history(html_content):
+    """Parse chip history from HTML（高速パスが使えない場合は全体解析）"""
+    started = time.perf_counter()
+    parser = 'soup'
+    chip_data = None
+    
+    if PARSER_ENGINE == 'fast':
+        try:
+            chip_data = parse_chip_history_fast(html_content)
+        except Exception as e:
+            logger.warning(f"Fast parser failed, falling back: {sanitize_error_message(e)}")
+        parser = 'fast' if chip_data is not None else 'fallback'
+        
+        # ⚡ サンプリングした一部のページで両パーサーの結果を突き合わせる
+        if chip_data is not None and PARSER_VERIFY_RATE > 0 and random.random() < PARSER_VERIFY_RATE:
+            expected = parse_chip_history_soup(html_content)
+            if expected != chip_data:
+                logger.warning("Fast parser mismatch detected, using fallback result")
+                chip_data, parser = expected, 'fallback'
+    
+    if chip_data is None:
+        chip_data = parse_chip_history_soup(html_content)
+    
+    parse_latency.observe(time.perf_counter() - started, parser)
+    parse_rows.observe(len(chip_data))
+    record_span('parse_chip_history', started, parser=parser, rows=len(chip_data))
+    return chip_data
+
+def compare_parsers(html_content) -> bool:
+    """高速パーサーとフォールバックの結果が一致するか検証"""
+    fast = parse_chip_history_fast(html_content)
+    return fast is None or fast == parse_chip_history_soup(html_content)
+
+# ⚡ 月単位のチップ履歴取得（キャッシュ経由）
+def get_cached_month_rows(email_hash, store_id, month):
+    """キャッシュまたは永続ストアにある月の行を取得（無ければNone）"""
+    cache_key = (email_hash, store_id, month)
+    cached = chip_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # ⚡ 同期済みの過去月は永続ストアから返す（上流へのアクセス不要）
+    if chip_store and month < current_month():
+        stored = chip_store.get_month(email_hash, store_id, month)
+        if stored is not None:
+            chip_cache.put(cache_key, stored)
+            return stored
+    
+    return None
+
+def month_url(store_id, month=None) -> str:
+    """月別チップ履歴ページのURL"""
+    if month:
+        return f'{BASE_URL}/players/chip_histories?month={month}&store_id={store_id}'
+    return f'{BASE_URL}/players/chip_histories?store_id={store_id}'
+
+def process_month_response(session_data, store_id, month, response):
+    """上流レスポンスをパースしてキャッシュ・永続ストアに保存"""
+    email_hash = session_data['email_hash']
+    cache_month = month or current_month()
+    session_manager.save_cookies(session_data)
+    
+    if response.status_code in TRANSIENT_STATUS_CODES:
+        raise TransientUpstreamError(f"Unexpected status {response.status_code}")
+    if response.status_code != 200:
+        raise UpstreamError(f"Unexpected status {response.status_code}")
+    
+    # 🔒 上流セッション切れでログイン画面に飛ばされた場合は空データをキャッシュしない
+    if 'sign_in' in response.url:
+        raise UpstreamError("Upstream session expired")
+    
+    rows = parse_chip_history(response.text)
+    chip_cache.put((email_hash, store_id, cache_month), rows)
+    if chip_store:
+        chip_store.put_month(email_hash, store_id, cache_month, rows)
+    return rows
+
+def fetch_month_rows(session_data, store_id, month=None):
+    """上流から指定月のチップ履歴を取得してキャッシュ・永続ストアに保存"""
+    with trace_span('fetch_month', store_id=store_id, month=month or current_month()):
+        response = session_data['session'].get(month_url(store_id, month), timeout=10)
+        return process_month_response(session_data, store_id, month, response)
+
+async def fetch_month_rows_async(session_data, store_id, month=None):
+    """fetch_month_rows の非同期版（パースと保存はワーカースレッドで実行）"""
+    with trace_span('fetch_month', store_id=store_id, month=month or current_month()):
+        response = await async_upstream.get(session_data['session'], month_url(store_id, month), timeout=10)
+        loop = asyncio.get_running_loop()
+        # トレースを引き継ぐためコンテキストごとワーカースレッドへ渡す
+        return await loop.run_in_executor(
+            None, contextvars.copy_context().run,
+            process_month_response, session_data, store_id, month, response
+        )
+
+# 🏪 店舗一覧の取得（キャッシュ経由）
+def store_list_key(email_hash):
+    """店舗一覧のキャッシュキー（当月扱いで CURRENT_MONTH_CACHE_TTL だけ保持）"""
+    return (email_hash, 'stores', current_month())
+
+def parse_store_list(html_content):
+    """チップ履歴ページの店舗選択から店舗一覧を取得"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+    stores = []
+    
+    store_select = soup.find('select', {'name': 'store_id'})
+    if store_select:
+        for option in store_select.find_all('option'):
+            stores.append({
+                'id': option.get('value'),
+                'name': option.get_text(strip=True)
+            })
+    return stores
+
+def process_store_list_response(session_data, response):
+    """上流レスポンスから店舗一覧をパースしてキャッシュに保存"""
+    session_manager.save_cookies(session_data)
+    if response.status_code in TRANSIENT_STATUS_CODES:
+        raise TransientUpstreamError(f"Unexpected status {response.status_code}")
+    if response.status_code != 200:
+        raise UpstreamError(f"Unexpected status {response.status_code}")
+    if 'sign_in' in response.url:
+        raise UpstreamError("Upstream session expired")
+    
+    stores = parse_store_list(response.text)
+    chip_cache.put(store_list_key(session_data['email_hash']), stores)
+    return stores
+
+def fetch_store_list(session_data):
+    """上流から店舗一覧を取得してキャッシュに保存"""
+    with trace_span('fetch_stores'):
+        response = session_data['session'].get(f'{BASE_URL}/players/chip_histories', timeout=10)
+        return process_store_list_response(session_data, response)
+
+async def fetch_store_list_async(session_data):
+    """fetch_store_list の非同期版（パースはワーカースレッドで実行）"""
+    with trace_span('fetch_stores'):
+        response = await async_upstream.get(
+            session_data['session'], f'{BASE_URL}/players/chip_histories', timeout=10
+        )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, contextvars.copy_context().run, process_store_list_response, session_data, response
+        )
+
+def submit_store_list_fetch(session_data, background=False) -> Future:
+    """店舗一覧を返す Future（キャッシュ済みなら即完了）"""
+    key = store_list_key(session_data['email_hash'])
+    cached = chip_cache.get(key)
+    if cached is not None:
+        future = Future()
+        future.set_result(cached)
+        return future
+    
+    if not background:
+        upstream_scheduler.promote(session_data['session_id'])
+    fetch = fetch_store_list_async if async_upstream else fetch_store_list
+    return month_fetch_flight.submit(
+        key,
+        lambda: submit_with_retry(session_data['session_id'], fetch, session_data, background=background)
+    )
+
+def retry_delay(attempt: int) -> float:
+    """再試行までの待ち時間（指数バックオフ + full jitter）"""
+    return random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt))
+
+def submit_with_retry(owner: str, fn, *args, background=False, **kwargs) -> Future:
+    """共有スケジューラで実行し、一時的なエラーはバックオフして再試行する
+
+    UPSTREAM_HEDGE が有効なら、直近の p95 を超えても終わらない試行に
+    同じリクエストを1つ追加し（上流に余裕がある場合のみ）、先に成功した方を使う。
+    返す Future をキャンセルすると実行待ちの試行もキャンセルする。
+    """
+    result = Future()
+    attempts = []  # 実行中・実行待ちの試行
+    failures = [0]
+    lock = threading.Lock()
+    parent_span = current_span.get()
+    
+    def launch(hedge=False):
+        if result.done():
+            return
+        # 遅延実行のスレッドから呼ばれても投入元のトレースに記録する
+        token = current_span.set(parent_span)
+        try:
+            attempt = upstream_scheduler.submit(owner, fn, *args, background=background, **kwargs)
+        finally:
+            current_span.reset(token)
+        with lock:
+            attempts.append(attempt)
+        attempt.add_done_callback(on_done)
+        if UPSTREAM_HEDGE and not hedge:
+            schedule_hedge(attempt)
+    
+    def schedule_hedge(attempt):
+        p95 = upstream_scheduler.latency_percentile(0.95)
+        if p95 is not None:
+            delayed_calls.call_later(max(UPSTREAM_HEDGE_MIN_DELAY, p95), lambda: maybe_hedge(attempt))
+    
+    def maybe_hedge(attempt):
+        if attempt.done() or result.done():
+            return
+        # まだ実行待ちなら、実行が始まってから改めて判断する
+        if not attempt.running():
+            schedule_hedge(attempt)
+            return
+        if upstream_scheduler.has_spare_capacity():
+            upstream_hedges.inc()
+            launch(hedge=True)
+    
+    def on_done(attempt):
+        with lock:
+            attempts.remove(attempt)
+            if result.done() or attempt.cancelled():
+                return
+            error = attempt.exception()
+            if error is None:
+                others = list(attempts)
+            elif attempts:
+                return  # もう一方の試行の結果を待つ
+            elif is_transient_error(error) and failures[0] < UPSTREAM_RETRIES:
+                failures[0] += 1
+                retry_attempt = failures[0]
+            else:
+                retry_attempt = None
+        
+        try:
+            if error is None:
+                result.set_result(attempt.result())
+                for other in others:
+                    upstream_scheduler.abort(other)
+            elif retry_attempt is not None:
+                upstream_retries.inc()
+                delay = retry_delay(retry_attempt)
+                logger.info(f"Retrying upstream request in {delay:.2f}s ({sanitize_error_message(error)})")
+                delayed_calls.call_later(delay, launch)
+            else:
+                result.set_exception(error)
+        except InvalidStateError:
+            pass  # 呼び出し元がキャンセル済み
+    
+    def on_result_done(future):
+        if future.cancelled():
+            with lock:
+                pending = list(attempts)
+            for attempt in pending:
+                upstream_scheduler.abort(attempt)
+    
+    result.add_done_callback(on_result_done)
+    launch()
+    return result
+
+def submit_month_fetch(session_data, store_id, month=None, background=False) -> Future:
+    """月の行を返す Future（キャッシュ済みなら即完了、それ以外は共有スケジューラで取得）"""
+    cached = get_cached_month_rows(session_data['email_hash'], store_id, month or current_month())
+    if cached is not None:
+        future = Future()
+        future.set_result(cached)
+        return future
+    
+    # 🔥 先読みの実行待ちに相乗りする場合に待たされないよう、通常の優先度に引き上げる
+    if not background:
+        upstream_scheduler.promote(session_data['session_id'])
+    
+    # ⚡ 同じ (ユーザー, 店舗, 月) の取得が実行中ならそれに相乗りする
+    fetch = fetch_month_rows_async if async_upstream else fetch_month_rows
+    flight_key = (session_data['email_hash'], store_id, month or current_month())
+    return month_fetch_flight.submit(
+        flight_key,
+        lambda: submit_with_retry(
+            session_data['session_id'], fetch, session_data, store_id, month, background=background
+        )
+    )
+
+def recent_months(count: int) -> list:
+    """当月から遡った count ヶ月分 (YYYY-MM)"""
+    year, month = map(int, current_month().split('-'))
+    months = []
+    for _ in range(count):
+        months.append(f'{year:04d}-{month:02d}')
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months
+
+def start_login_prefetch(session_data):
+    """店舗一覧と、その先頭（アプリの既定店舗）の直近 PREFETCH_MONTHS ヶ月を低優先度で取得"""
+    def prefetch_months(stores_future):
+        if stores_future.cancelled() or stores_future.exception() is not None:
+            return
+        stores = stores_future.result()
+        if not stores or not validate_store_id(stores[0]['id'] or ''):
+            return
+        for month in recent_months(PREFETCH_MONTHS):
+            submit_month_fetch(session_data, stores[0]['id'], month, background=True)
+    
+    # 完了通知はワーカー・イベントループ上で呼ばれるため、キャッシュ参照は遅延実行スレッドで行う
+    submit_store_list_fetch(session_data, background=True).add_done_callback(
+        lambda stores_future: delayed_calls.call_later(0, lambda: prefetch_months(stores_future))
+    )
+
 # 🔒 定期的なセッションクリーンアップ（バックグラウンドタスク）
 def cleanup_sessions_periodically():
     """定期的に期限切れセッションをクリーンアップ"""
-    import threading
     def cleanup_loop():
         while True:
-            time.sleep(3600)  # 1時間ごと
+            time.sleep(SESSION_CLEANUP_INTERVAL)
             session_manager.cleanup_expired_sessions()
     
     thread = threading.Thread(target=cleanup_loop, daemon=True)
     thread.start()
 
-# アプリ起動時にクリーンアップスレッドを開始
-cleanup_sessions_periodically()
+background_tasks_pid = None
+background_tasks_lock = threading.Lock()
+
+def start_background_tasks():
+    """バックグラウンドタスクをワーカープロセスごとに一度だけ開始
+
+    pre-fork サーバーで fork 前にスレッドを作らないよう、
+    各プロセスの最初のリクエストで呼ばれる。
+    """
+    global background_tasks_pid
+    if background_tasks_pid == os.getpid():
+        return
+    with background_tasks_lock:
+        if background_tasks_pid == os.getpid():
+            return
+        background_tasks_pid = os.getpid()
+    cleanup_sessions_periodically()
+    static_assets.start_precompress()
+
+def create_app() -> Flask:
+    """アプリを生成（gunicorn では 'combined_server:create_app()' を指定）"""
+    app = Flask(__name__)
+    
+    # 🔒 セキュリティ設定
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+    app.config['SESSION_COOKIE_SECURE'] = True  # HTTPS only
+    app.config['SESSION_COOKIE_HTTPONLY'] = True  # XSS対策
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Strict'  # CSRF対策
+    
+    # 📈 レート制限で拒否された分も計測するため Limiter より先に登録
+    app.before_request(start_request_timer)
+    app.after_request(record_request_metrics)
+    app.before_request(start_request_trace)
+    app.after_request(finish_request_trace)
+    app.teardown_request(clear_request_trace)
+    
+    if DEV_MODE:
+        # 開発モード: すべてのVercelドメインとサンドボックスを許可
+        CORS(app, 
+             resources={r"/*": {
+                 "origins": "*",  # 開発中は全許可
+                 "methods": ["GET", "POST", "OPTIONS"],
+                 "allow_headers": ["Content-Type", "X-Session-ID", "If-None-Match"],
+                 "expose_headers": ["Content-Type", "ETag"],
+                 "supports_credentials": False,  # *を使う場合はFalse必須
+                 "max_age": 3600
+             }})
+        logger.info("🔓 CORS: Development mode - all origins allowed")
+    else:
+        # 本番モード: 特定のオリジンのみ
+        CORS(app, 
+             resources={r"/*": {
+                 "origins": ALLOWED_ORIGINS,
+                 "methods": ["GET", "POST", "OPTIONS"],
+                 "allow_headers": ["Content-Type", "X-Session-ID", "If-None-Match"],
+                 "expose_headers": ["Content-Type", "ETag"],
+                 "supports_credentials": True,
+                 "max_age": 3600
+             }})
+        logger.info(f"🔒 CORS: Production mode - allowed origins: {ALLOWED_ORIGINS}")
+    
+    limiter.init_app(app)
+    app.register_blueprint(routes)
+    
+    # 静的ファイルの一覧は fork 前に作ってワーカー間で共有する
+    static_assets.index()
+    app.before_request(start_background_tasks)
+    return app
 
 if __name__ == '__main__':
     logger.info("🔒 Starting secure server...")
     logger.info(f"Session timeout: {session_manager.session_timeout}")
-    app.run(host='0.0.0.0', port=5060, debug=False)
+    create_app().run(host='0.0.0.0', port=5060, debug=False)
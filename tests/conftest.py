@@ -0,0 +1,11 @@
+"""combined_server.py のテスト共通設定"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# テスト中はディスクへの永続化を行わない
+os.environ.setdefault('CHIP_STORE_PATH', '')
+os.environ.setdefault('STATIC_CACHE_DIR', '')
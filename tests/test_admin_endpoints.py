@@ -0,0 +1,27 @@
+"""統計・メトリクスのエンドポイントが METRICS_TOKEN で保護されていることのテスト"""
+
+import pytest
+
+import combined_server as server
+
+ADMIN_PATHS = ['/metrics', '/proxy/api/cache_stats', '/proxy/api/upstream_stats']
+
+
+@pytest.fixture
+def client():
+    return server.create_app().test_client()
+
+
+@pytest.mark.parametrize('path', ADMIN_PATHS)
+def test_disabled_without_token(client, monkeypatch, path):
+    monkeypatch.setattr(server, 'METRICS_TOKEN', '')
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer '}).status_code == 401
+
+
+@pytest.mark.parametrize('path', ADMIN_PATHS)
+def test_requires_matching_token(client, monkeypatch, path):
+    monkeypatch.setattr(server, 'METRICS_TOKEN', 'secret-token')
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer secret-token'}).status_code == 200
@@ -0,0 +1,29 @@
+"""ChipHistoryStore のテスト（永続化はベストエフォート）"""
+
+import os
+import stat
+
+import combined_server as server
+
+
+def test_unavailable_database_is_treated_as_miss():
+    store = server.ChipHistoryStore('/proc/nonexistent/chip.db')
+    store.put_month('user', '6', '2020-01', [{'date': '2020-01-01'}])
+    assert store.get_month('user', '6', '2020-01') is None
+    assert 'error' in store.stats()
+
+
+def test_completed_month_round_trip(tmp_path):
+    store = server.ChipHistoryStore(str(tmp_path / 'chip.db'))
+    rows = [{'date': '2020-01-01', 'store_name': '京都河原町店'}]
+    store.put_month('user', '6', '2020-01', rows)
+    assert store.get_month('user', '6', '2020-01') == rows
+    assert store.stats() == {'months': 1, 'users': 1}
+
+
+def test_database_files_are_private(tmp_path):
+    path = tmp_path / 'chip.db'
+    store = server.ChipHistoryStore(str(path))
+    store.put_month('user', '6', '2020-01', [{'date': '2020-01-01'}])
+    for suffix in ('', '-wal', '-shm'):
+        assert stat.S_IMODE(os.stat(f'{path}{suffix}').st_mode) == 0o600
@@ -0,0 +1,78 @@
+"""Accept / Accept-Encoding のq値に従った形式・圧縮方式選択のテスト"""
+
+import pytest
+
+import combined_server as server
+
+app = server.create_app()
+BODY = b'x' * (server.COMPRESS_MIN_BYTES + 1)
+BEST = 'br' if server.brotli else 'gzip'
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('br;q=0, gzip', 'gzip'),
+    ('gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('br;q=0, gzip;q=0', None),
+    ('*', BEST),
+    ('*, gzip;q=0', 'br' if server.brotli else None),
+    ('identity', None),
+    ('', None),
+])
+def test_choose_encoding_respects_quality(accept_encoding, expected):
+    with app.test_request_context(headers={'Accept-Encoding': accept_encoding}):
+        assert server.choose_encoding(BODY) == expected
+
+
+def test_choose_encoding_prefers_higher_quality():
+    with app.test_request_context(headers={'Accept-Encoding': 'br;q=0.5, gzip;q=0.9'}):
+        assert server.choose_encoding(BODY) == 'gzip'
+
+
+def test_static_response_respects_quality(tmp_path):
+    web_dir = tmp_path / 'web'
+    web_dir.mkdir()
+    (web_dir / 'main.dart.js').write_text('console.log("app");\n' * 500)
+    cache = server.StaticAssetCache(str(web_dir), '')
+    cache.index()
+    cache.precompress()
+    asset = cache.get('main.dart.js')
+    
+    with app.test_request_context(headers={'Accept-Encoding': 'br;q=0, gzip'}):
+        assert server.static_response(asset).headers.get('Content-Encoding') == 'gzip'
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip;q=0'}):
+        assert 'Content-Encoding' not in server.static_response(asset).headers
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('application/msgpack;q=0, application/json', 'application/json'),
+    ('application/msgpack;q=0.5, application/json', 'application/json'),
+    ('application/msgpack, application/json', 'application/msgpack'),
+    ('application/x-msgpack', 'application/x-msgpack'),
+    ('*/*', 'application/json'),
+    ('', 'application/json'),
+])
+def test_preferred_mimetype_respects_quality(accept, expected):
+    headers = {'Accept': accept} if accept else {}
+    with app.test_request_context(headers=headers):
+        assert server.preferred_mimetype(server.MSGPACK_MIMETYPES) == expected
+
+
+@pytest.mark.skipif(server.msgpack is None, reason='msgpack is not installed')
+def test_encode_body_skips_refused_msgpack():
+    with app.test_request_context(headers={'Accept': 'application/msgpack;q=0, application/json'}):
+        assert server.encode_body({'success': True})[1] == 'application/json'
+    with app.test_request_context(headers={'Accept': 'application/msgpack'}):
+        assert server.encode_body({'success': True})[1] == 'application/msgpack'
+
+
+@pytest.mark.parametrize('accept, streamed', [
+    ('application/x-ndjson', True),
+    ('application/x-ndjson;q=0, application/json', False),
+    ('application/json, application/x-ndjson;q=0.5', False),
+    ('*/*', False),
+])
+def test_ndjson_streaming_respects_quality(accept, streamed):
+    with app.test_request_context(headers={'Accept': accept}):
+        chosen = server.preferred_mimetype(('application/x-ndjson',))
+    assert (chosen == 'application/x-ndjson') == streamed
@@ -0,0 +1,43 @@
+"""高速パーサーと全体解析（BeautifulSoup）の差分テスト
+
+tests/fixtures/chip_history_pages/ の各ページで、parse_chip_history の結果が
+フォールバックと一致することを確認する。
+"""
+
+import os
+
+import pytest
+
+import combined_server as server
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'chip_history_pages')
+PAGE_NAMES = sorted(name for name in os.listdir(PAGES_DIR) if name.endswith(('.html', '.htm')))
+
+
+def load_page(name):
+    with open(os.path.join(PAGES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name', PAGE_NAMES)
+def test_fast_parser_matches_soup(name):
+    html = load_page(name)
+    assert server.compare_parsers(html)
+    assert server.parse_chip_history(html) == server.parse_chip_history_soup(html)
+
+
+def test_length_changing_lowercase_falls_back():
+    html = load_page('dotted_capital_i_before_table.html')
+    assert server.parse_chip_history_fast(html) is None
+    assert len(server.parse_chip_history(html)) == 3
+
+
+def test_fast_path_is_used_for_typical_page():
+    html = load_page('typical_month.html')
+    rows = server.parse_chip_history_fast(html)
+    assert rows is not None and len(rows) == 17
+
+
+@pytest.mark.parametrize('name', ['unclosed_table_after_last_close.html', 'table_markup_in_attribute.html'])
+def test_ambiguous_table_bounds_fall_back(name):
+    assert server.parse_chip_history_fast(load_page(name)) is None
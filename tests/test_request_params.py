@@ -0,0 +1,26 @@
+"""リクエストパラメータの検証のテスト"""
+
+import pytest
+
+import combined_server as server
+
+PARSERS = [server.parse_batch_params, server.parse_sync_params, server.parse_export_params]
+
+
+@pytest.mark.parametrize('parse', PARSERS)
+@pytest.mark.parametrize('store_ids, error', [
+    ([], 'No stores provided'),
+    ('6', 'No stores provided'),
+    (['6'] * (server.MAX_BATCH_STORES + 1), 'Too many stores requested'),
+    (['6', 7], 'Invalid store ID'),
+    (['../6'], 'Invalid store ID'),
+])
+def test_store_ids_are_validated_the_same_way(parse, store_ids, error):
+    result = parse({'store_ids': store_ids, 'months': ['2025-01'], 'since': '2025-01'})
+    assert result[-1] == error
+
+
+def test_store_ids_default_and_deduplicate():
+    assert server.parse_store_ids({}) == (['6'], None)
+    assert server.parse_store_ids({'store_id': '7'}) == (['7'], None)
+    assert server.parse_store_ids({'store_ids': ['7', '6', '7']}) == (['7', '6'], None)
@@ -0,0 +1,50 @@
+"""セッション保存先のテスト（上流のCookieを他のワーカー・再起動後と共有する）"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import combined_server as server
+
+STORE_PAGE = '<select name="store_id"><option value="6">京都河原町店</option></select>'
+
+
+def upstream_response(session, name, value):
+    # 上流が Set-Cookie で発行したCookieは requests が CookieJar に反映する
+    session.cookies.set(name, value, domain='upstream.example', path='/')
+    return SimpleNamespace(status_code=200, url='https://upstream.example/players/chip_histories', text=STORE_PAGE)
+
+
+def test_cookies_from_upstream_response_are_saved(tmp_path, monkeypatch):
+    path = str(tmp_path / 'sessions.db')
+    manager = server.SecureSessionManager(server.SQLiteSessionBackend(path))
+    monkeypatch.setattr(server, 'session_manager', manager)
+    session_id = manager.create_session('player@example.com')
+    session_data = manager.get_session_data(session_id)
+    
+    response = upstream_response(session_data['session'], '_session', 'rotated')
+    assert server.process_store_list_response(session_data, response)
+    
+    # 別のワーカー・再起動後のプロセスからも新しいCookieが見える
+    other = server.SQLiteSessionBackend(path).get(session_id)
+    assert other['session'].cookies.get('_session') == 'rotated'
+
+
+def test_unchanged_cookies_are_not_rewritten(tmp_path):
+    backend = server.SQLiteSessionBackend(str(tmp_path / 'sessions.db'))
+    manager = server.SecureSessionManager(backend)
+    session_data = manager.get_session_data(manager.create_session('player@example.com'))
+    
+    writes = []
+    backend.db.execute = lambda sql, params=(): writes.append(sql)
+    manager.save_cookies(session_data)
+    assert writes == []
+
+
+def test_incomplete_backend_fails_at_creation():
+    class IncompleteBackend(server.SessionBackend):
+        def get(self, session_id):
+            return None
+    
+    with pytest.raises(TypeError):
+        IncompleteBackend()
@@ -0,0 +1,37 @@
+"""SQLiteDatabase のファイル権限のテスト"""
+
+import os
+import stat
+
+import combined_server as server
+
+
+def file_mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_private_database_files_are_owner_only(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    old_umask = os.umask(0o022)
+    try:
+        db = server.SQLiteDatabase(path, 'CREATE TABLE IF NOT EXISTS t (value TEXT);', private=True)
+        db.execute('INSERT INTO t VALUES (?)', ('cookie-secret',))
+    finally:
+        os.umask(old_umask)
+    
+    for suffix in ('', '-wal', '-shm'):
+        assert os.path.exists(path + suffix)
+        assert file_mode(path + suffix) == 0o600, suffix
+
+
+def test_existing_wal_files_are_tightened(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    db = server.SQLiteDatabase(path, 'CREATE TABLE IF NOT EXISTS t (value TEXT);')
+    db.execute('INSERT INTO t VALUES (?)', ('cookie-secret',))
+    for suffix in ('', '-wal', '-shm'):
+        os.chmod(path + suffix, 0o644)
+    
+    private = server.SQLiteDatabase(path, 'CREATE TABLE IF NOT EXISTS t (value TEXT);', private=True)
+    private.execute('SELECT * FROM t')
+    for suffix in ('', '-wal', '-shm'):
+        assert file_mode(path + suffix) == 0o600, suffix
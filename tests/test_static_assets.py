@@ -0,0 +1,75 @@
+"""StaticAssetCache の圧縮版保存先のテスト"""
+
+import gzip
+import os
+import stat
+
+import combined_server as server
+
+
+def make_cache(tmp_path, cache_dir):
+    web_dir = tmp_path / 'web'
+    web_dir.mkdir()
+    (web_dir / 'main.dart.js').write_text('console.log("app");\n' * 500)
+    cache = server.StaticAssetCache(str(web_dir), str(cache_dir))
+    cache.index()
+    return cache
+
+
+def test_cache_dir_is_created_private(tmp_path):
+    cache_dir = tmp_path / 'static-cache'
+    cache = make_cache(tmp_path, cache_dir)
+    cache.precompress()
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+    assert cache.get('main.dart.js').variants['gzip'].path.startswith(str(cache_dir))
+
+
+def test_shared_cache_dir_is_not_trusted(tmp_path):
+    cache_dir = tmp_path / 'shared'
+    cache_dir.mkdir(mode=0o777)
+    os.chmod(cache_dir, 0o777)
+    cache = make_cache(tmp_path, cache_dir)
+    asset = cache.get('main.dart.js')
+    # 他のユーザーが置いた圧縮版（中身は別物）
+    (cache_dir / f'{asset.digest}.gz').write_bytes(b'planted')
+    
+    cache.precompress()
+    variant = asset.variants['gzip']
+    assert cache.cache_dir == ''
+    assert variant.path is None and variant.body != b'planted'
+
+
+def test_symlinked_cache_dir_is_not_trusted(tmp_path):
+    target = tmp_path / 'elsewhere'
+    target.mkdir(mode=0o700)
+    link = tmp_path / 'link'
+    link.symlink_to(target)
+    cache = make_cache(tmp_path, link)
+    cache.precompress()
+    assert cache.cache_dir == ''
+
+
+def test_large_variant_in_memory_mode_keeps_body(tmp_path):
+    web_dir = tmp_path / 'web'
+    web_dir.mkdir()
+    # 圧縮後も STATIC_SENDFILE_MIN_BYTES を超える大きさにする
+    (web_dir / 'main.dart.js').write_text(os.urandom(300 * 1024).hex())
+    cache = server.StaticAssetCache(str(web_dir), '')
+    cache.index()
+    cache.precompress()
+    asset = cache.get('main.dart.js')
+    
+    variant = asset.variants['gzip']
+    assert variant.path is None
+    assert variant.size >= server.STATIC_SENDFILE_MIN_BYTES
+    assert variant.body is not None
+    with server.create_app().test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = server.static_response(asset)
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == asset_bytes(asset)
+
+
+def asset_bytes(asset):
+    with open(asset.path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,35 @@
+"""summary_columns のキャッシュが chip_cache の容量上限に含まれることのテスト"""
+
+import combined_server as server
+
+
+def month_rows(month, count=20):
+    return [
+        {'date': f'{month}-{28 - i:02d} 18:00', 'ring_chips': i, 'tournament_chips': 0, 'purchase': 0,
+         'total_change': i, 'current_balance': 1000 + i, 'store_name': '京都河原町店'}
+        for i in range(count)
+    ]
+
+
+def test_summary_entries_count_against_chip_cache_budget(monkeypatch):
+    cache = server.ChipHistoryCache(200_000, 300)
+    monkeypatch.setattr(server, 'chip_cache', cache)
+    rows_by_store = {'6': {'2020-01': month_rows('2020-01'), '2020-02': month_rows('2020-02')}}
+    
+    columns = server.summary_columns('user', rows_by_store)
+    assert len(columns) == 40
+    assert cache.total_bytes > 0
+    # 同じ行リストなら再利用する
+    assert server.summary_columns('user', rows_by_store) is columns
+    
+    for n in range(100):
+        server.summary_columns(f'user{n}', {'6': {'2020-01': month_rows('2020-01')}})
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.evictions > 0
+
+
+def test_changed_rows_rebuild_columns(monkeypatch):
+    monkeypatch.setattr(server, 'chip_cache', server.ChipHistoryCache(1_000_000, 300))
+    columns = server.summary_columns('user', {'6': {'2020-01': month_rows('2020-01')}})
+    rebuilt = server.summary_columns('user', {'6': {'2020-01': month_rows('2020-01', 5)}})
+    assert rebuilt is not columns and len(rebuilt) == 5
@@ -0,0 +1,61 @@
+"""UpstreamScheduler の回帰テスト"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import combined_server as server
+
+
+class CompletedClient:
+    """コルーチンをその場で実行し、完了済みの Future を返す非同期クライアント"""
+    def run(self, coro):
+        future = Future()
+        future.set_result(asyncio.run(coro))
+        return future
+
+
+async def quick(value):
+    return value
+
+
+def run_with_timeout(target, timeout=10):
+    """target を別スレッドで実行し、終わらなければ失敗にする（デッドロック検出）"""
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'scheduler deadlocked'
+
+
+def test_already_completed_async_task_does_not_deadlock():
+    scheduler = server.UpstreamScheduler(4, CompletedClient())
+    results = []
+    run_with_timeout(lambda: results.extend(
+        scheduler.submit('owner', quick, i).result(timeout=5) for i in range(20)
+    ))
+    assert results == list(range(20))
+    assert scheduler.stats()['active'] == 0
+
+
+def test_quick_coroutines_from_many_threads():
+    scheduler = server.UpstreamScheduler(8, server.AsyncUpstreamClient(8))
+    results = []
+    lock = threading.Lock()
+
+    def worker(owner):
+        futures = [scheduler.submit(owner, quick, i) for i in range(50)]
+        values = [future.result(timeout=5) for future in futures]
+        with lock:
+            results.extend(values)
+
+    def run():
+        threads = [threading.Thread(target=worker, args=(f'owner{n}',)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    run_with_timeout(run)
+    assert len(results) == 200
+    assert scheduler.stats()['active'] == 0
+    assert not scheduler.async_tasks